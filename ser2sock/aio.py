@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import functools
+
+from .comm import monotonic
+from .server import Server, LoopProfiler
+
+
+def new_event_loop():
+    try:
+        import uvloop
+    except ImportError:
+        return asyncio.new_event_loop()
+    logging.info("Using uvloop")
+    return uvloop.new_event_loop()
+
+
+class AsyncServer(Server):
+    """
+    Server running the bridges on an asyncio event loop (uvloop if
+    installed) instead of a hand-made selector loop.
+    """
+
+    def __init__(self, config):
+        Server.__init__(self, config)
+        self.loop = new_event_loop()
+
+    def _new_selector(self):
+        # the asyncio loop does the selecting
+        return None
+
+    def close(self):
+        self._close_stats()
+        for bridge in self.bridges:
+            bridge.close()
+        self._close_self_channel()
+        if not self.loop.is_closed():
+            self.loop.close()
+
+    def _on_internal_event(self):
+        Server._on_internal_event(self)
+        if not self.run_flag:
+            self.loop.stop()
+
+    def _wrap(self, cb):
+        if self.profiler is None:
+            return cb
+        return functools.partial(self.profiler.run, cb)
+
+    def enable_profiling(self, slow_callback=0.1):
+        """
+        Time the callbacks registered from now on (the loop iterations
+        themselves are run by asyncio so their lag is not measured)
+        """
+        self.profiler = LoopProfiler(slow_callback)
+
+    def disable_profiling(self):
+        self.profiler = None
+
+    def add_reader(self, reader, cb):
+        self.loop.add_reader(reader, self._wrap(cb))
+
+    def remove_reader(self, reader):
+        return self.loop.remove_reader(reader)
+
+    def add_writer(self, writer, cb):
+        self.loop.add_writer(writer, self._wrap(cb))
+
+    def remove_writer(self, writer):
+        return self.loop.remove_writer(writer)
+
+    def call_later(self, delay, callback):
+        return self.loop.call_later(delay, self._wrap(callback))
+
+    def call_at(self, when, callback):
+        # when is given in the monotonic() clock which may not be the loop's
+        when = when - monotonic() + self.loop.time()
+        return self.loop.call_at(when, self._wrap(callback))
+
+    def step(self):
+        self.loop.call_soon(self.loop.stop)
+        self.loop.run_forever()
+
+    def run(self):
+        if self.run_flag:
+            self.loop.run_forever()
+        self.close()
@@ -1,50 +1,598 @@
+import os
+import errno
+import random
 import socket
 import logging
 import datetime
+import functools
+import collections
 
 import serial
 
-from .config import tcp_host_port
-from .comm import create_serial, create_server, setsockopt
+from .framing import create_framer
+from .capture import (
+    Capture,
+    capture_dir,
+    capture_name,
+    TCP_TO_SERIAL,
+    SERIAL_TO_TCP,
+    DISCARDED,
+)
+from .metrics import Histogram
+from .transaction import Arbiter
+from .config import (
+    tcp_host_port,
+    tcp_options,
+    serial_options,
+    bridge_id,
+    SERIAL_BRIDGE_DEFAULTS,
+)
+from .comm import (
+    create_serial,
+    create_server,
+    setsockopt,
+    client_options,
+    is_alive,
+    serial_fileno,
+    readinto_fd,
+    write_fd,
+    send,
+    cork,
+    splice_supported,
+    Pipe,
+    monotonic,
+)
+
+
+def log_data(msg, data):
+    # avoid copying memory views when nobody is listening
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug(msg, bytes(data))
+
+
+def observe_written(queue, written, histogram):
+    """
+    queue holds the [size, monotonic time] of each chunk waiting in a
+    buffer, oldest first. Account for written bytes leaving the buffer:
+    chunks fully written are removed and their own wait observed
+    """
+    now = None
+    while queue and written >= queue[0][0]:
+        size, queued_at = queue.popleft()
+        written -= size
+        if now is None:
+            now = monotonic()
+        histogram.observe(now - queued_at)
+    if queue and written:
+        queue[0][0] -= written
+
+
+class Client:
+    """A TCP client attached to a bridge"""
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.ts = datetime.datetime.now()
+        # last time data was received from the client (monotonic clock)
+        self.last_active = monotonic()
+        # reading from the client is paused (serial buffer full)
+        self.paused = False
+        # data waiting for the client to become writable
+        self.buffer = bytearray()
+        # kernel pipe used in zero copy mode
+        self.pipe = None
+        # TCP_CORK is set (see Bridge.flush_batch)
+        self.corked = False
+        # size and arrival time of the chunks in buffer (see observe_written)
+        self.queued = collections.deque()
+
+    @property
+    def buffered(self):
+        return len(self.buffer) + (self.pipe.pending if self.pipe else 0)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+def create_listener(config):
+    tcp = tcp_options(config["tcp"])
+    tcp["address"] = tcp_host_port(tcp.pop("address"))
+    tcp["listen"] = max(tcp["listen"], config["tcp"]["max_clients"])
+    return create_server(**tcp)
+
+
+def prepare_bridge(config):
+    """
+    Create the resources of a bridge which may be slow to obtain: serial
+    object (opened if open_policy is "always_open") and listening socket.
+    Does not touch the event loop so it can run in a thread (see
+    Server._make_bridges). Returns the resources argument of Bridge
+    """
+    ser = create_serial(serial_options(config["serial"]))
+    if config["serial"]["open_policy"] == "always_open":
+        try:
+            ser.open()
+        except Exception as error:
+            logging.error("error openning serial port %r", error)
+    try:
+        return ser, create_listener(config)
+    except Exception:
+        ser.close()
+        raise
+
+
+def release_bridge(resources):
+    """close the resources created by prepare_bridge"""
+    ser, sock = resources
+    sock.close()
+    ser.close()
+
+
+class BridgeStatus:
+    """
+    Copy of the configuration and statistics of a bridge, safe to use
+    outside the event loop (ex: from the web UI thread or the supervisor)
+    """
+
+    def __init__(self, config, status=None):
+        self.config = config
+        for name in Bridge.status_fields:
+            setattr(self, name, None)
+        if status:
+            self.__dict__.update(status)
 
 
 class Bridge:
-    def __init__(self, config, server):
+
+    # statistics exposed to the outside world (ex: web UI, worker supervisor)
+    status_fields = (
+        "address",
+        "client_addrs",
+        "client_ts",
+        "client_nb",
+        "client_bytes",
+        "client_buffered",
+        "client_dropped",
+        "serial_bytes",
+        "serial_buffered",
+        "serial_state",
+        "serial_losses",
+        "reconnect_attempts",
+        "serial_frames",
+        "serial_frame_max",
+        "cache_hits",
+        "cache_misses",
+        "client_reads",
+        "client_errors",
+        "serial_reads",
+        "transactions",
+        "timeouts",
+        "latency",
+        "capture_file",
+    )
+
+    def __init__(self, config, server, resources=None):
         self.config = config
         self.server = server
-        self.sock = None
-        self.client = None
+        if resources is None:
+            resources = create_serial(serial_options(config["serial"])), None
+        self.serial, self.sock = resources
+        self.clients = []
         self.client_bytes = 0
         self.client_ts = None
         self.client_nb = 0
-        self.serial = create_serial(config["serial"])
+        # bytes not sent to slow clients (slow_client="drop")
+        self.client_dropped = 0
+        self.client_reads = 0
+        # clients dropped because of an error
+        self.client_errors = 0
+        self.serial_fd = None
+        self.serial_paused = False
         self.serial_bytes = 0
-        self.ensure_server()
+        self.serial_reads = 0
+        # read credit left for this loop iteration (see serial_allowance)
+        self.deficit = 0
+        # closes the serial line (open_policy="idle_timeout")
+        self.idle_timer = None
+        # "closed", "open" or "reconnecting" (after the device was lost)
+        self.serial_state = "closed"
+        self.serial_losses = 0
+        self.reconnect_attempts = 0
+        self.reconnect_timer = None
+        # data waiting for the serial line to become writable
+        self.serial_buffer = bytearray()
+        # size and arrival time of the chunks in serial_buffer
+        self.serial_queued = collections.deque()
+        # kernel pipe used in zero copy mode
+        self.serial_pipe = None
+        # time (seconds) data waits inside ser2sock before reaching the serial
+        # line / the clients and, in transaction mode, request to reply time
+        self.histograms = dict(
+            tcp_to_serial=Histogram(),
+            serial_to_tcp=Histogram(),
+            transaction=Histogram(),
+        )
+        # stream mode framing of the serial data (see make_framer)
+        self.framer = None
+        self.frame_timer = None
+        self.serial_frames = 0
+        self.serial_frame_max = 0
+        self.make_framer()
+        # serial data waiting to be sent to the clients (batch_delay)
+        self.batch = bytearray()
+        self.batch_timer = None
+        # arrival time of the oldest byte waiting in batch / in the framer
+        # (see Bridge.histograms)
+        self.batch_since = None
+        self.frame_since = None
+        self.tcp_view = self.serial_view = None
+        self.make_buffers()
+        self.arbiter = None
+        self.make_arbiter()
+        # traffic recorder (see make_capture)
+        self.capture = None
+        self.make_capture()
+        if self.sock is None:
+            self.ensure_server()
+        else:
+            self.server.add_reader(self.sock, self.accept)
+        self.apply_open_policy()
+
+    @property
+    def address(self):
+        """actual address the bridge is listening on"""
+        return self.sock.getsockname() if self.sock else None
+
+    @property
+    def client_addrs(self):
+        return [client.addr for client in self.clients]
+
+    @property
+    def client_buffered(self):
+        """number of bytes waiting to be sent to the clients"""
+        return sum(client.buffered for client in self.clients)
+
+    @property
+    def serial_buffered(self):
+        """number of bytes waiting to be written to the serial line"""
+        pending = self.serial_pipe.pending if self.serial_pipe else 0
+        return len(self.serial_buffer) + pending
+
+    @property
+    def cache(self):
+        return self.arbiter.cache if self.arbiter is not None else None
+
+    @property
+    def cache_hits(self):
+        return self.cache.hits if self.cache is not None else None
+
+    @property
+    def cache_misses(self):
+        return self.cache.misses if self.cache is not None else None
+
+    @property
+    def transactions(self):
+        return self.arbiter.transactions if self.arbiter is not None else None
+
+    @property
+    def timeouts(self):
+        return self.arbiter.timeouts if self.arbiter is not None else None
+
+    @property
+    def latency(self):
+        return dict((name, hist.state()) for name, hist in self.histograms.items())
+
+    def status(self):
+        return dict((name, getattr(self, name)) for name in self.status_fields)
+
+    def make_buffers(self):
+        """(re)allocate the receive buffers reused on every event"""
+        tcp_size = self.config["tcp"]["buffer_size"]
+        if self.tcp_view is None or len(self.tcp_view) != tcp_size:
+            self.tcp_view = memoryview(bytearray(tcp_size))
+        serial_size = self.config["serial"]["buffer_size"]
+        if self.serial_view is None or len(self.serial_view) != serial_size:
+            self.serial_view = memoryview(bytearray(serial_size))
+
+    def make_arbiter(self):
+        if self.arbiter is not None:
+            self.arbiter.reset()
+        transaction = self.config["tcp"]["mode"] == "transaction"
+        self.arbiter = Arbiter(self) if transaction else None
 
     def ensure_serial(self):
-        if self.serial.isOpen():
+        self.cancel_idle_timer()
+        if self.serial_state == "open":
             return
-        self.serial.open()
+        if not self.serial.isOpen():
+            # may have been opened beforehand (see prepare_bridge)
+            self.serial.open()
+        self.serial_fd = serial_fileno(self.serial)
         self.server.add_reader(self.serial, self.serial_to_tcp)
+        self.serial_state = "open"
+
+    def attach_serial(self):
+        """
+        Make sure the serial line is there for a new client. Returns False
+        if the client must be rejected
+        """
+        opts = self.config["serial"]
+        if self.serial_state != "reconnecting":
+            try:
+                self.ensure_serial()
+                return True
+            except Exception as error:
+                logging.error("error openning serial port %r", error)
+                if not opts["reconnect"]:
+                    return False
+                self.schedule_reconnect()
+        # don't let clients trigger open storms: wait for the reconnection
+        return opts["keep_clients"]
+
+    def lose_serial(self, error):
+        """
+        The serial line failed (ex: USB adapter unplugged). Close it and,
+        if reconnect is enabled, try to reopen it with a capped exponential
+        backoff. With keep_clients the clients stay connected meanwhile
+        (their data is queued up to the serial high water mark)
+        """
+        opts = self.config["serial"]
+        logging.error("serial line %r lost: %r", opts["port"], error)
+        self.serial_losses += 1
+        if not (opts["reconnect"] and opts["keep_clients"]):
+            self.close_clients()
+        self.close_serial()
+        if opts["reconnect"]:
+            self.resume_clients()
+            self.schedule_reconnect()
+
+    def schedule_reconnect(self):
+        opts = self.config["serial"]
+        delay = opts["reconnect_delay"] * 2 ** min(self.reconnect_attempts, 32)
+        # jitter spreads the reconnections of bridges lost at the same time
+        delay = min(delay, opts["reconnect_max_delay"]) * random.uniform(0.5, 1)
+        self.serial_state = "reconnecting"
+        self.reconnect_timer = self.server.call_later(delay, self.reconnect_serial)
+
+    def reconnect_serial(self):
+        self.reconnect_timer = None
+        self.reconnect_attempts += 1
+        port = self.config["serial"]["port"]
+        try:
+            self.ensure_serial()
+        except Exception as error:
+            logging.info(
+                "reconnect %r failed (attempt %d): %r",
+                port,
+                self.reconnect_attempts,
+                error,
+            )
+            self.schedule_reconnect()
+            return
+        logging.info("serial line %r is back", port)
+        self.reconnect_attempts = 0
+        if self.serial_buffer:
+            self.server.add_writer(self.serial, self.flush_serial)
+        self.apply_open_policy()
+
+    def apply_open_policy(self):
+        """
+        Open or close the serial line when there are no clients, according
+        to open_policy: "on_demand" closes it, "always_open" opens it (even
+        before the first client arrives) and "idle_timeout" closes it after
+        idle_timeout seconds without clients
+        """
+        if self.clients or self.serial_state == "reconnecting":
+            return
+        opts = self.config["serial"]
+        policy = opts["open_policy"]
+        if policy == "always_open":
+            try:
+                self.ensure_serial()
+            except Exception as error:
+                logging.error("error openning serial port %r", error)
+        elif not self.serial.isOpen():
+            return
+        elif policy == "on_demand":
+            self.close_serial()
+        elif self.idle_timer is None:
+            self.idle_timer = self.server.call_later(
+                opts["idle_timeout"], self.on_idle_timeout
+            )
+
+    def cancel_idle_timer(self):
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+
+    def on_idle_timeout(self):
+        self.idle_timer = None
+        if not self.clients:
+            logging.info("close idle serial line %r", self.config["serial"]["port"])
+            self.close_serial()
+
+    def make_framer(self):
+        """(re)create the serial framer from the current options"""
+        opts = self.config["serial"]
+        keys = ("frame_terminator", "frame_size", "frame_length_prefix", "frame_gap")
+        if not any(opts[key] for key in keys):
+            self.framer = None
+            return
+        self.framer = create_framer(
+            terminator=opts["frame_terminator"],
+            size=opts["frame_size"],
+            length_prefix=opts["frame_length_prefix"],
+        )
+
+    @property
+    def capture_file(self):
+        """file the traffic is being recorded to (None if not capturing)"""
+        return self.capture.filename if self.capture is not None else None
+
+    @property
+    def capture_filename(self):
+        directory = self.server.config.get("capture_dir") or capture_dir()
+        return os.path.join(directory, capture_name(bridge_id(self.config)))
+
+    def make_capture(self):
+        """(re)start or stop recording the traffic from the current options"""
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
+        opts = self.config["serial"]
+        if not opts["capture"]:
+            return
+        filename = self.capture_filename
+        try:
+            self.capture = Capture(
+                filename, opts["capture_size"], opts["capture_rotate"]
+            )
+        except Exception as error:
+            logging.error("cannot capture to %r: %r", filename, error)
+            return
+        logging.info("capturing %r traffic to %r", opts["port"], filename)
 
     def ensure_server(self):
         if self.sock is None:
-            tcp = dict(self.config["tcp"])
-            tcp["address"] = tcp_host_port(tcp.pop("address"))
-            self.sock = create_server(**tcp)
+            self.sock = create_listener(self.config)
             self.server.add_reader(self.sock, self.accept)
         return self.sock
 
-    def close_client(self):
-        if self.client:
-            self.server.remove_reader(self.client)
-            self.client.close()
-            self.client = None
+    def close_client(self, client):
+        if client not in self.clients:
+            return
+        self.server.remove_reader(client.sock)
+        self.server.remove_writer(client.sock)
+        client.sock.close()
+        self.clients.remove(client)
+        if self.arbiter is not None:
+            self.arbiter.forget(client)
+        if client.pipe is not None:
+            client.pipe.close()
+            client.pipe = None
+            self.close_pipes()
+        self.resume_serial()
+
+    def close_clients(self):
+        for client in list(self.clients):
+            self.close_client(client)
+
+    def drop_client(self, client):
+        """close the client and apply the serial open_policy if it was the last"""
+        self.close_client(client)
+        self.apply_open_policy()
 
     def close_serial(self):
+        self.cancel_idle_timer()
+        if self.reconnect_timer is not None:
+            self.reconnect_timer.cancel()
+            self.reconnect_timer = None
         if self.serial.isOpen():
             self.server.remove_reader(self.serial)
+            self.server.remove_writer(self.serial)
             self.serial.close()
+        self.serial_state = "closed"
+        self.serial_fd = None
+        self.serial_paused = False
+        del self.serial_buffer[:]
+        self.serial_queued.clear()
+        del self.batch[:]
+        if self.batch_timer is not None:
+            self.batch_timer.cancel()
+            self.batch_timer = None
+        if self.framer is not None:
+            self.framer.flush()
+        if self.frame_timer is not None:
+            self.frame_timer.cancel()
+            self.frame_timer = None
+        self.close_pipes()
+        if self.arbiter is not None:
+            self.arbiter.reset()
+
+    def can_splice(self):
+        """
+        Data may bypass python: nothing needs to look at it (framing,
+        batching, read budget, transaction mode) and a single client
+        """
+        tcp, ser = self.config["tcp"], self.config["serial"]
+        return (
+            splice_supported()
+            and self.serial_fd is not None
+            and tcp["max_clients"] == 1
+            and self.arbiter is None
+            and self.framer is None
+            and not tcp["batch_delay"]
+            and ser["read_budget"] is None
+        )
+
+    def open_pipes(self, client):
+        if not self.config["tcp"]["zero_copy"]:
+            return
+        if not self.can_splice():
+            logging.info("zero copy not available: fall back to copy")
+            return
+        self.serial_pipe, client.pipe = Pipe(), Pipe()
+
+    def close_pipes(self):
+        if self.serial_pipe is not None:
+            self.serial_pipe.close()
+            self.serial_pipe = None
+        for client in self.clients:
+            if client.pipe is not None:
+                client.pipe.close()
+                client.pipe = None
+
+    def unsplice(self, client, error):
+        """
+        Leave zero copy mode when the kernel refuses to splice one of the
+        file descriptors. Data already in the pipes goes through user space.
+        """
+        if error.errno not in (errno.EINVAL, errno.ENOSYS):
+            raise error
+        logging.info("zero copy not supported (%r): fall back to copy", error)
+        self.leave_zero_copy(client)
+
+    def leave_zero_copy(self, client):
+        """close the pipes, data already in them goes through user space"""
+        serial_data = self.serial_pipe.read()
+        client_data = client.pipe.read()
+        self.close_pipes()
+        if serial_data:
+            self.write_serial(serial_data)
+        if client_data:
+            self.write_client(client, client_data)
+
+    def pause_clients(self):
+        for client in self.clients:
+            if not client.paused:
+                logging.debug("pause reading from %r (serial buffer full)", client.addr)
+                self.server.remove_reader(client.sock)
+                client.paused = True
+
+    def resume_clients(self):
+        for client in self.clients:
+            if client.paused:
+                logging.debug("resume reading from %r", client.addr)
+                cb = functools.partial(self.tcp_to_serial, client)
+                self.server.add_reader(client.sock, cb)
+                client.paused = False
+
+    def pause_serial(self):
+        if self.serial.isOpen() and not self.serial_paused:
+            logging.debug("pause reading from serial (client buffer full)")
+            self.server.remove_reader(self.serial)
+            self.serial_paused = True
+
+    def resume_serial(self):
+        if not self.serial.isOpen() or not self.serial_paused:
+            return
+        low_water = self.config["tcp"]["low_water"]
+        if any(client.buffered > low_water for client in self.clients):
+            return
+        logging.debug("resume reading from serial")
+        self.server.add_reader(self.serial, self.serial_to_tcp)
+        self.serial_paused = False
 
     def close_server(self):
         if self.sock:
@@ -52,101 +600,525 @@ class Bridge:
             self.sock.close()
             self.sock = None
 
-    def tcp_to_serial(self):
+    def tcp_to_serial(self, client):
         try:
-            self._tcp_to_serial()
+            self._tcp_to_serial(client)
         except Exception as error:
+            # serial line errors are handled by write_serial
             logging.error("error tcp -> serial: %r", error)
-            self.close_serial()
-            self.close_client()
-
-    def _tcp_to_serial(self):
-        data = self.client.recv(1024)
-        if data:
-            logging.debug("tcp -> serial: %r", data)
-            self.serial.write(data)
-            self.client_bytes += len(data)
+            self.client_errors += 1
+            self.drop_client(client)
+
+    def _tcp_to_serial(self, client):
+        if self.serial_pipe is not None:
+            try:
+                return self._splice_tcp_to_serial(client)
+            except OSError as error:
+                return self.unsplice(client, error)
+        n = client.sock.recv_into(self.tcp_view)
+        if n:
+            data = self.tcp_view[:n]
+            log_data("tcp -> serial: %r", data)
+            if self.capture is not None:
+                self.capture.write(TCP_TO_SERIAL, data)
+            self.client_bytes += n
+            self.client_reads += 1
+            client.last_active = monotonic()
+            if self.arbiter is None:
+                self.write_serial(data)
+            else:
+                self.arbiter.on_request_data(client, data)
         else:
-            logging.info("connection closed")
-            self.close_serial()
-            self.close_client()
+            logging.info("connection closed by %r", client.addr)
+            self.drop_client(client)
+
+    def _splice_tcp_to_serial(self, client):
+        pipe = self.serial_pipe
+        n = pipe.fill(client.fileno(), self.config["tcp"]["buffer_size"])
+        if n is None:
+            return
+        if not n:
+            logging.info("connection closed by %r", client.addr)
+            self.drop_client(client)
+            return
+        self.client_bytes += n
+        self.client_reads += 1
+        client.last_active = monotonic()
+        pipe.drain(self.serial_fd)
+        if pipe.pending:
+            self.server.add_writer(self.serial, self.flush_serial)
+            self.pause_clients()
+
+    def _write_serial(self, data):
+        if self.serial_fd is None:
+            return self.serial.write(data)
+        return write_fd(self.serial_fd, data)
+
+    def write_serial(self, data):
+        """
+        Write to the serial line without blocking. Whatever cannot be
+        written immediately is queued and flushed when the serial line
+        becomes writable. Reading from the clients is paused while the
+        queue is above the high water mark.
+
+        Chunks are queued as a whole so data coming from different
+        clients is never interleaved inside a chunk.
+        """
+        buff = self.serial_buffer
+        if not buff and self.serial_state == "open":
+            try:
+                data = data[self._write_serial(data) :]
+            except Exception as error:
+                return self.lose_serial(error)
+            if not data:
+                self.histograms["tcp_to_serial"].observe(0.0)
+                return
+            self.server.add_writer(self.serial, self.flush_serial)
+        self.serial_queued.append([len(data), monotonic()])
+        buff += data
+        if len(buff) >= self.config["serial"]["high_water"]:
+            self.pause_clients()
+
+    def flush_serial(self):
+        try:
+            self._flush_serial()
+        except Exception as error:
+            self.lose_serial(error)
+
+    def _flush_serial(self):
+        pipe = self.serial_pipe
+        if pipe is not None and pipe.pending:
+            try:
+                pipe.drain(self.serial_fd)
+            except OSError as error:
+                return self.unsplice(self.clients[0], error)
+            if not pipe.pending and not self.serial_buffer:
+                self.server.remove_writer(self.serial)
+                self.resume_clients()
+            return
+        buff = self.serial_buffer
+        written = self._write_serial(buff)
+        del buff[:written]
+        observe_written(self.serial_queued, written, self.histograms["tcp_to_serial"])
+        if not buff:
+            self.server.remove_writer(self.serial)
+        if len(buff) <= self.config["serial"]["low_water"]:
+            self.resume_clients()
 
     def serial_to_tcp(self):
         try:
             self._serial_to_tcp()
         except Exception as error:
-            logging.error("error reading from serial %r", error)
-            self.close_client()
-            self.close_serial()
-            return
+            self.lose_serial(error)
+
+    def serial_allowance(self):
+        """
+        Number of bytes the serial line may read in this loop iteration
+        (None: no limit). Deficit round robin: each iteration credits
+        read_budget * weight bytes. Credit left while data is pending is
+        kept for the next iteration and dropped once the line is drained.
+        Chatty lines can therefore not starve the other bridges.
+        """
+        opts = self.config["serial"]
+        if opts["read_budget"] is None:
+            return None
+        # weight may be a float, the credit is a number of bytes
+        self.deficit += int(opts["read_budget"] * opts["weight"])
+        return self.deficit
 
     def _serial_to_tcp(self):
-        data = self.serial.read(self.serial.inWaiting())
-        if self.client is None:
-            logging.info("serial data discarded (no client): %r", data)
-        else:
-            logging.debug("serial -> tcp: %r", data)
-            self.client.sendall(data)
-            self.serial_bytes += len(data)
+        if self.serial_pipe is not None:
+            client = self.clients[0]
+            try:
+                return self._splice_serial_to_tcp(client)
+            except OSError as error:
+                return self.unsplice(client, error)
+        view = self.serial_view
+        allowance = self.serial_allowance()
+        if self.serial_fd is None:
+            waiting = self.serial.inWaiting()
+            size = min(waiting, len(view))
+            if allowance is not None:
+                size = min(size, allowance)
+            n = self.serial.readinto(view[:size])
+            if allowance is not None:
+                self.deficit = allowance - n if waiting > n else 0
+            self.forward_serial(view[:n])
+            return
+        # fast path: drain the file descriptor directly
+        while True:
+            if allowance is None:
+                chunk = view
+            else:
+                chunk = view[: min(len(view), allowance)]
+            n = readinto_fd(self.serial_fd, chunk)
+            if n is None:
+                break
+            if not n:
+                raise serial.SerialException(
+                    "device reports readiness to read but returned no data"
+                )
+            self.forward_serial(view[:n])
+            if allowance is not None:
+                allowance -= n
+                self.deficit = allowance
+                if not allowance:
+                    # budget spent: the rest waits for the next iteration
+                    return
+            if n < len(chunk):
+                # drained: credit left is dropped
+                break
+            if self.serial_paused or not self.serial.isOpen():
+                # data may still be waiting: credit left is kept
+                return
+        self.deficit = 0
+
+    def _splice_serial_to_tcp(self, client):
+        pipe = client.pipe
+        n = pipe.fill(self.serial_fd, self.config["serial"]["buffer_size"])
+        if n is None:
+            return
+        if not n:
+            raise serial.SerialException(
+                "device reports readiness to read but returned no data"
+            )
+        self.serial_bytes += n
+        self.serial_reads += 1
+        pipe.drain(client.fileno())
+        if pipe.pending:
+            cb = functools.partial(self.flush_client, client)
+            self.server.add_writer(client.sock, cb)
+            self.pause_serial()
+
+    def forward_serial(self, data):
+        if not self.clients:
+            logging.info("%d bytes of serial data discarded (no client)", len(data))
+            if self.capture is not None:
+                self.capture.write(DISCARDED, data)
+            return
+        log_data("serial -> tcp: %r", data)
+        if self.capture is not None:
+            self.capture.write(SERIAL_TO_TCP, data)
+        self.serial_bytes += len(data)
+        self.serial_reads += 1
+        if self.arbiter is not None:
+            self.arbiter.on_reply_data(data)
+            return
+        if self.framer is not None:
+            self.frame_serial(data)
+            return
+        self.send_serial(data)
+
+    def send_serial(self, data, since=None):
+        """
+        send serial data (or a whole frame) to all clients. since: arrival
+        time of the data when it was held by ser2sock (default: now)
+        """
+        if self.config["tcp"]["batch_delay"]:
+            self.batch_serial(data, since)
+            return
+        for client in list(self.clients):
+            try:
+                self.write_client(client, data, since)
+            except Exception as error:
+                logging.error("error writing to client %r", error)
+                self.client_errors += 1
+                self.drop_client(client)
+
+    def frame_serial(self, data):
+        """
+        Split the serial stream into frames (frame_terminator, frame_size,
+        frame_length_prefix and/or an idle gap of frame_gap seconds) so
+        that each frame goes out in a single send. A frame growing beyond
+        frame_max bytes is sent as is.
+        """
+        opts = self.config["serial"]
+        framer = self.framer
+        now = monotonic()
+        if not len(framer):
+            self.frame_since = now
+        for frame in framer.feed(data):
+            self.send_frame(frame, self.frame_since)
+            # what is left arrived now
+            self.frame_since = now
+        if len(framer) >= opts["frame_max"]:
+            self.send_frame(framer.flush(), self.frame_since)
+        if self.frame_timer is not None:
+            self.frame_timer.cancel()
+            self.frame_timer = None
+        if opts["frame_gap"] and len(framer):
+            self.frame_timer = self.server.call_later(
+                opts["frame_gap"], self.on_frame_timeout
+            )
+
+    def on_frame_timeout(self):
+        self.frame_timer = None
+        frame = self.framer.flush()
+        if frame:
+            self.send_frame(frame, self.frame_since)
+
+    def send_frame(self, frame, since=None):
+        self.serial_frames += 1
+        self.serial_frame_max = max(self.serial_frame_max, len(frame))
+        self.send_serial(frame, since)
+
+    def batch_serial(self, data, since=None):
+        """
+        Coalesce serial data (like the FTDI latency timer): send it when
+        batch_size bytes are waiting or batch_delay seconds after the first
+        byte. While data keeps coming the clients are corked so that the
+        kernel only sends full segments. They are uncorked when the line
+        goes quiet.
+        """
+        batch = self.batch
+        if not batch:
+            self.batch_since = monotonic() if since is None else since
+        batch += data
+        if len(batch) >= self.config["tcp"]["batch_size"]:
+            self.flush_batch(more=True)
+        if self.batch_timer is None:
+            delay = self.config["tcp"]["batch_delay"]
+            self.batch_timer = self.server.call_later(delay, self.on_batch_timeout)
+
+    def on_batch_timeout(self):
+        self.batch_timer = None
+        self.flush_batch(more=False)
+
+    def flush_batch(self, more):
+        data = bytes(self.batch)
+        del self.batch[:]
+        since = self.batch_since
+        for client in list(self.clients):
+            try:
+                if more and not client.corked:
+                    client.corked = cork(client.sock, True)
+                if data:
+                    self.write_client(client, data, since)
+                if not more and client.corked:
+                    cork(client.sock, False)
+                    client.corked = False
+            except Exception as error:
+                logging.error("error writing to client %r", error)
+                self.client_errors += 1
+                self.drop_client(client)
+
+    def write_client(self, client, data, since=None):
+        """
+        Send to the client without blocking. Whatever cannot be sent
+        immediately is buffered and flushed when the client becomes
+        writable. When the buffer is above the high water mark the
+        slow_client policy decides what happens: pause reading from the
+        serial line (default), drop data for this client or disconnect it.
+        since is the arrival time of data if ser2sock held it before (batch,
+        framer)
+        """
+        buff = client.buffer
+        if not buff:
+            data = data[send(client.sock, data) :]
+            if not data:
+                latency = 0.0 if since is None else monotonic() - since
+                self.histograms["serial_to_tcp"].observe(latency)
+                return
+            cb = functools.partial(self.flush_client, client)
+            self.server.add_writer(client.sock, cb)
+        policy = self.config["tcp"]["slow_client"]
+        if len(buff) >= self.config["tcp"]["high_water"]:
+            if policy == "drop":
+                self.client_dropped += len(data)
+                return
+            elif policy == "disconnect":
+                logging.warning("disconnect slow client %r", client.addr)
+                self.drop_client(client)
+                return
+        client.queued.append([len(data), monotonic() if since is None else since])
+        buff += data
+        if policy == "pause" and len(buff) >= self.config["tcp"]["high_water"]:
+            self.pause_serial()
+
+    def flush_client(self, client):
+        try:
+            self._flush_client(client)
+        except Exception as error:
+            logging.error("error writing to client %r", error)
+            self.client_errors += 1
+            self.drop_client(client)
+
+    def _flush_client(self, client):
+        pipe = client.pipe
+        if pipe is not None and pipe.pending:
+            try:
+                pipe.drain(client.fileno())
+            except OSError as error:
+                return self.unsplice(client, error)
+            if not pipe.pending and not client.buffer:
+                self.server.remove_writer(client.sock)
+                self.resume_serial()
+            return
+        buff = client.buffer
+        written = send(client.sock, buff)
+        del buff[:written]
+        observe_written(client.queued, written, self.histograms["serial_to_tcp"])
+        if not buff:
+            self.server.remove_writer(client.sock)
+        self.resume_serial()
 
     def close(self):
-        self.close_client()
+        self.close_clients()
         self.close_serial()
         self.close_server()
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
 
     def accept(self):
         opts = self.config["tcp"]
-        client, addr = self.sock.accept()
-        setsockopt(client, no_delay=opts["no_delay"], tos=opts["tos"])
+        sock, addr = self.sock.accept()
+        setsockopt(sock, **client_options(opts))
         self.client_nb += 1
         self.client_ts = datetime.datetime.now()
-        if self.client is None:
+        if len(self.clients) >= opts["max_clients"]:
+            self.make_room(addr)
+        if len(self.clients) < opts["max_clients"]:
             logging.info("new connection from %r", addr)
-            try:
-                serial = self.ensure_serial()
-            except Exception as error:
-                logging.error("error openning serial port %r", error)
-                client.close()
+            if not self.attach_serial():
+                sock.close()
                 return
-            self.client = client
-            self.client.setblocking(False)
-            self.server.add_reader(client, self.tcp_to_serial)
+            client = Client(sock, addr)
+            sock.setblocking(False)
+            self.clients.append(client)
+            self.open_pipes(client)
+            cb = functools.partial(self.tcp_to_serial, client)
+            self.server.add_reader(sock, cb)
         else:
             logging.info("disconnect client %r (already connected)", addr)
-            client.close()
+            sock.close()
+
+    def make_room(self, addr):
+        """
+        All client slots are taken: free the ones held by dead peers (ex:
+        half-open connections not yet detected by keepalive) and then apply
+        the takeover policy: "reject" the new client, "replace_oldest"
+        client or replace the least active client if it has been idle for
+        more than takeover_idle seconds ("replace_if_idle")
+        """
+        for client in list(self.clients):
+            if not is_alive(client.sock):
+                logging.info("close dead client %r", client.addr)
+                self.close_client(client)
+        if not self.clients:
+            return
+        opts = self.config["tcp"]
+        policy = opts["takeover"]
+        if policy == "replace_oldest":
+            victim = self.clients[0]
+        elif policy == "replace_if_idle":
+            victim = min(self.clients, key=lambda client: client.last_active)
+            if monotonic() - victim.last_active < opts["takeover_idle"]:
+                return
+        else:
+            return
+        logging.info("client %r replaced by %r", victim.addr, addr)
+        self.close_client(victim)
+
+    def _new_listener(self, config):
+        """listening socket for the new tcp address of config"""
+        try:
+            return create_listener(config)
+        except OSError:
+            if self.sock is None:
+                raise
+        # the new address may overlap the current one (ex: same port on
+        # another interface): free it and try again
+        self.close_server()
+        try:
+            return create_listener(config)
+        except Exception:
+            self.ensure_server()
+            raise
+
+    def _restore_listener(self, sock):
+        sock.close()
+        if self.sock is None:
+            self.ensure_server()
+
+    def _set_serial(self, old_ser, new_ser):
+        """apply the changed pyserial options, all or none"""
+        applied = []
+        try:
+            for key, value in new_ser.items():
+                old_value = old_ser.get(key)
+                if key in SERIAL_BRIDGE_DEFAULTS or value == old_value:
+                    continue
+                port = old_ser["port"]
+                logging.info("setting %r %r from %r to %r", port, key, old_value, value)
+                setattr(self.serial, key, value)
+                applied.append((key, old_value))
+        except Exception:
+            for key, old_value in reversed(applied):
+                setattr(self.serial, key, old_value)
+            raise
 
     def reconfig(self, config):
+        """
+        Apply a new configuration. Raises if the new tcp address or a
+        serial option cannot be applied, leaving the bridge as it was
+        """
         if self.config == config:
             name = self.config["serial"]["port"]
             logging.info("reconfig %r: no changes, so skip it", name)
             return
         old_ser, new_ser = self.config["serial"], config["serial"]
-        if old_ser != new_ser:
+        old_tcp, new_tcp = self.config["tcp"], config["tcp"]
+        # steps which may fail come first and leave the bridge untouched
+        # when they do (see Server.reconfig)
+        sock = None
+        if old_tcp["address"] != new_tcp["address"]:
+            sock = self._new_listener(config)
+        try:
             if old_ser["port"] != new_ser["port"]:
                 self.close_serial()
-            for key, value in new_ser.items():
-                old_value = old_ser[key]
-                if value != old_value:
-                    logging.info(
-                        "setting %r %r from %r to %r",
-                        old_ser["port"],
-                        key,
-                        old_value,
-                        value,
-                    )
-                    setattr(self.serial, key, value)
-        old_tcp, new_tcp = self.config["tcp"], config["tcp"]
+            self._set_serial(old_ser, new_ser)
+        except Exception:
+            if sock is not None:
+                self._restore_listener(sock)
+            raise
         if old_tcp != new_tcp:
-            if old_tcp["address"] != new_tcp["address"]:
-                self.close_client()
+            if sock is not None:
+                self.close_clients()
                 self.close_server()
-                self.config = config
-                self.ensure_server()
+                self.sock = sock
+                self.server.add_reader(sock, self.accept)
             else:
                 # other tcp options changed
-                opts = dict(no_delay=new_tcp["no_delay"], tos=new_tcp["tos"])
-                if self.client:
-                    setsockopt(self.client, **opts)
-                if self.server:
-                    setsockopt(self.server, **opts)
+                opts = client_options(new_tcp)
+                for client in self.clients:
+                    setsockopt(client.sock, **opts)
+                if self.sock:
+                    setsockopt(self.sock, **opts)
         self.config = config
+        self.make_buffers()
+        frame_keys = [key for key in SERIAL_BRIDGE_DEFAULTS if key.startswith("frame_")]
+        if any(old_ser[key] != new_ser[key] for key in frame_keys):
+            if self.framer is not None and len(self.framer):
+                self.send_frame(self.framer.flush(), self.frame_since)
+            self.make_framer()
+        capture_keys = ("capture", "capture_size", "capture_rotate")
+        if any(old_ser[key] != new_ser[key] for key in capture_keys):
+            self.make_capture()
+        if old_tcp["mode"] != new_tcp["mode"]:
+            self.make_arbiter()
+        elif self.arbiter is not None:
+            cache_keys = ("cache", "cache_ttl", "cache_size")
+            if any(old_tcp[key] != new_tcp[key] for key in cache_keys):
+                self.arbiter.make_cache()
+        if self.clients and self.serial_state == "closed":
+            # port changed under the feet of the clients
+            if not self.attach_serial():
+                self.close_clients()
+        if self.serial_pipe is not None and not self.can_splice():
+            logging.info("zero copy no longer possible: fall back to copy")
+            self.leave_zero_copy(self.clients[0])
+        policy_keys = ("open_policy", "idle_timeout")
+        if any(old_ser[key] != new_ser[key] for key in policy_keys):
+            self.cancel_idle_timer()
+        self.apply_open_policy()
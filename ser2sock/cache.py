@@ -0,0 +1,55 @@
+import re
+import collections
+
+from .comm import monotonic
+
+
+class ReplyCache:
+    """
+    Size bounded LRU mapping of requests to their last reply. Entries
+    expire ttl seconds after being stored.
+
+    patterns is a sequence of requests which may be cached: either
+    bytes (exact match) or compiled bytes regular expressions (full match).
+    """
+
+    def __init__(self, patterns, ttl=1.0, size=128):
+        self.exact = set(p for p in patterns if isinstance(p, bytes))
+        # anchored at the end: full match (Pattern.fullmatch is python 3 only)
+        self.regexes = [
+            re.compile(b"(?:" + p.pattern + b")\\Z", p.flags)
+            for p in patterns
+            if not isinstance(p, bytes)
+        ]
+        self.ttl = ttl
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def cacheable(self, request):
+        if request in self.exact:
+            return True
+        return any(regex.match(request) for regex in self.regexes)
+
+    def get(self, request):
+        """cached reply for request or None (counts hits and misses)"""
+        entry = self.entries.get(request)
+        if entry is not None:
+            expires, reply = entry
+            if expires > monotonic():
+                # most recently used go last
+                self.entries[request] = self.entries.pop(request)
+                self.hits += 1
+                return reply
+            del self.entries[request]
+        self.misses += 1
+
+    def put(self, request, reply):
+        self.entries.pop(request, None)
+        self.entries[request] = monotonic() + self.ttl, reply
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
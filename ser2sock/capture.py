@@ -0,0 +1,291 @@
+import os
+import sys
+import mmap
+import time
+import struct
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+from .config import cache_dir, is_private
+
+# record directions
+TCP_TO_SERIAL = 0
+SERIAL_TO_TCP = 1
+# serial data received while no client was connected
+DISCARDED = 2
+
+DIRECTIONS = ("tcp->serial", "serial->tcp", "discarded")
+
+MAGIC = b"S2SC"
+VERSION = 1
+
+# magic, version, size of the ring, sequence number (odd while a record
+# is being written), head and tail (absolute positions: the ring holds the
+# records between tail and head, position % size gives the offset)
+HEADER = struct.Struct("<4sIIQQQ")
+# timestamp, direction, captured length, original length
+RECORD = struct.Struct("<dBII")
+
+# pcap link type for private use: each packet starts with the direction
+PCAP_LINKTYPE = 147
+PCAP_HEADER = struct.Struct("<IHHiIII")
+PCAP_RECORD = struct.Struct("<IIII")
+
+
+def capture_dir():
+    """default capture directory, private to the current user"""
+    return os.path.join(cache_dir(), "capture")
+
+
+def private_dir(directory):
+    """create directory (mode 0700) and check nobody else can write to it"""
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    if not is_private(os.stat(directory)):
+        msg = "{0} is not private (owned by another user or writable by others)"
+        raise OSError(msg.format(directory))
+
+
+def create_private(filename):
+    """
+    Truncate or create filename (mode 0600) for writing, without following
+    symbolic links. Returns a file object
+    """
+    flags = os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, "O_NOFOLLOW", 0)
+    fd = os.open(filename, flags, 0o600)
+    fobj = os.fdopen(fd, "r+b")
+    if not is_private(os.fstat(fd)):
+        fobj.close()
+        raise OSError("{0} belongs to another user".format(filename))
+    return fobj
+
+
+def capture_name(bid):
+    """capture file name of a bridge (see config.bridge_id)"""
+    name = "".join(c if c.isalnum() or c in "-_." else "_" for c in bid)
+    return name.strip("_") + ".cap"
+
+
+def _get(buff, size, pos, n):
+    offset = HEADER.size + pos % size
+    first = min(n, HEADER.size + size - offset)
+    data = buff[offset : offset + first]
+    if first < n:
+        data += buff[HEADER.size : HEADER.size + n - first]
+    return data
+
+
+def _records(buff, size, tail, head):
+    """(position, timestamp, direction, data, original length) of each record"""
+    pos = tail
+    while pos < head:
+        ts, direction, caplen, length = RECORD.unpack(
+            _get(buff, size, pos, RECORD.size)
+        )
+        data = _get(buff, size, pos + RECORD.size, caplen)
+        yield pos, ts, direction, data, length
+        pos += RECORD.size + caplen
+
+
+def write_pcap(filename, records):
+    """write (timestamp, direction, data, original length) records"""
+    with create_private(filename) as fobj:
+        fobj.write(PCAP_HEADER.pack(0xA1B2C3D4, 2, 4, 0, 0, 65535, PCAP_LINKTYPE))
+        for ts, direction, data, length in records:
+            sec = int(ts)
+            usec = int(round((ts - sec) * 1e6))
+            fobj.write(PCAP_RECORD.pack(sec, usec, len(data) + 1, length + 1))
+            fobj.write(struct.pack("B", direction))
+            fobj.write(data)
+
+
+class Capture:
+    """
+    Records the traffic of a bridge (timestamp, direction and payload) into
+    a fixed size memory mapped ring file: the oldest records are overwritten
+    once the ring is full. Payloads larger than a quarter of the ring are
+    truncated. With rotate, the records are saved to a pcap file
+    (<filename>.<n>.pcap, the last rotate files are kept) before being
+    overwritten: they are copied from the ring by write and the file is
+    written by a background thread. See read_capture and main for the
+    decoding side
+    """
+
+    def __init__(self, filename, size=1024 * 1024, rotate=0):
+        self.filename = filename
+        self.size = size
+        self.snaplen = size // 4
+        self.rotate = rotate
+        self.rotations = 0
+        # records before this position have been saved (see rotate)
+        self.rotated = 0
+        # pcap files waiting to be written by the saver thread
+        self.saves = None
+        self.saver = None
+        self.seq = 0
+        self.head = self.tail = 0
+        directory = os.path.dirname(filename)
+        if directory:
+            private_dir(directory)
+        with create_private(filename) as fobj:
+            fobj.write(HEADER.pack(MAGIC, VERSION, size, 0, 0, 0))
+            fobj.write(b"\0" * size)
+            fobj.flush()
+            self.mmap = mmap.mmap(fobj.fileno(), 0)
+
+    def _put(self, pos, data):
+        offset = HEADER.size + pos % self.size
+        first = min(len(data), HEADER.size + self.size - offset)
+        self.mmap[offset : offset + first] = data[:first]
+        if first < len(data):
+            self.mmap[HEADER.size : HEADER.size + len(data) - first] = data[first:]
+
+    def _header(self):
+        HEADER.pack_into(
+            self.mmap, 0, MAGIC, VERSION, self.size, self.seq, self.head, self.tail
+        )
+
+    def write(self, direction, data):
+        length = len(data)
+        caplen = min(length, self.snaplen)
+        total = RECORD.size + caplen
+        if self.rotate and self.head + total - self.rotated > self.size:
+            self.save()
+        self.seq += 1
+        self._header()
+        # make room by dropping the oldest records
+        while self.head + total - self.tail > self.size:
+            record = _get(self.mmap, self.size, self.tail, RECORD.size)
+            self.tail += RECORD.size + RECORD.unpack(record)[2]
+        self._put(self.head, RECORD.pack(time.time(), direction, caplen, length))
+        self._put(self.head + RECORD.size, data[:caplen])
+        self.head += total
+        self.seq += 1
+        self._header()
+
+    def save(self):
+        """
+        Save the records not saved yet to the next pcap file. Only the copy
+        of the records happens here (the caller is the event loop)
+        """
+        records = [
+            record[1:]
+            for record in _records(self.mmap, self.size, self.tail, self.head)
+            if record[0] >= self.rotated
+        ]
+        self.rotations += 1
+        self.rotated = self.head
+        if self.saver is None:
+            self.saves = queue.Queue()
+            self.saver = threading.Thread(
+                target=self._run_saver, name="ser2sock-capture-saver"
+            )
+            self.saver.daemon = True
+            self.saver.start()
+        self.saves.put((self.rotations, records))
+
+    def _run_saver(self):
+        while True:
+            item = self.saves.get()
+            if item is None:
+                return
+            try:
+                self._save(*item)
+            except (OSError, IOError) as error:
+                logging.error("could not save capture of %r: %r", self.filename, error)
+
+    def _save(self, rotation, records):
+        write_pcap("{0}.{1}.pcap".format(self.filename, rotation), records)
+        old = "{0}.{1}.pcap".format(self.filename, rotation - self.rotate)
+        if rotation > self.rotate and os.path.exists(old):
+            os.unlink(old)
+
+    def close(self):
+        if self.saver is not None:
+            # let the pending pcap files be written
+            self.saves.put(None)
+            self.saver.join()
+            self.saver = None
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+
+def read_capture(filename, retries=100):
+    """
+    Records (timestamp, direction, data, original length) of a capture
+    file, oldest first. A consistent copy is taken while the capture may
+    still be running
+    """
+    with open(filename, "rb") as fobj:
+        buff = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        for _ in range(retries):
+            magic, version, size, seq, head, tail = HEADER.unpack_from(buff, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError("{0} is not a ser2sock capture file".format(filename))
+            if seq & 1:
+                continue
+            data = buff[:]
+            if HEADER.unpack_from(buff, 0)[3] == seq:
+                break
+        else:
+            raise RuntimeError("{0} keeps changing".format(filename))
+    finally:
+        buff.close()
+    return [record[1:] for record in _records(data, size, tail, head)]
+
+
+def _dump(records, hexdump):
+    import datetime
+
+    for ts, direction, data, length in records:
+        when = datetime.datetime.fromtimestamp(ts).isoformat(" ")
+        truncated = "" if len(data) == length else " (truncated)"
+        print(
+            "{0} {1:<11} {2} bytes{3}".format(
+                when, DIRECTIONS[direction], length, truncated
+            )
+        )
+        if hexdump:
+            for i in range(0, len(data), 16):
+                chunk = " ".join(
+                    "{0:02x}".format(byte) for byte in bytearray(data[i : i + 16])
+                )
+                print("    {0:04x}  {1}".format(i, chunk))
+        else:
+            print("    {0!r}".format(data))
+
+
+def main(args=None):
+    import optparse
+
+    parser = optparse.OptionParser(
+        usage="%prog [options] <capture file>",
+        description="decode the traffic captured by a ser2sock bridge",
+    )
+    parser.add_option(
+        "--hex", action="store_true", default=False, help="hexadecimal dump"
+    )
+    parser.add_option("--pcap", help="write the records to this pcap file instead")
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("Missing capture file argument")
+    try:
+        records = read_capture(args[0])
+    except (OSError, ValueError, RuntimeError) as error:
+        print("{0}: {1}".format(args[0], error))
+        sys.exit(1)
+    if options.pcap:
+        write_pcap(options.pcap, records)
+    else:
+        _dump(records, options.hex)
+
+
+if __name__ == "__main__":
+    main()  # pragma: no cover
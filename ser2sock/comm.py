@@ -1,3 +1,6 @@
+import os
+import time
+import errno
 import socket
 
 import serial
@@ -9,20 +12,85 @@ IPTOS_RELIABILITY = 0x04
 IPTOS_MINCOST = 0x02
 
 
-def setsockopt(sock, reuse_addr=None, no_delay=None, tos=None):
+monotonic = getattr(time, "monotonic", time.time)
+
+try:
+    TimeoutError = TimeoutError
+except NameError:  # python 2
+
+    class TimeoutError(OSError):
+        pass
+
+
+def setsockopt(
+    sock,
+    reuse_addr=None,
+    no_delay=None,
+    tos=None,
+    keepalive=None,
+    keep_idle=None,
+    keep_interval=None,
+    keep_count=None,
+    user_timeout=None,
+):
     if reuse_addr is not None:
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 if reuse_addr else 0)
     if no_delay is not None and hasattr(socket, "TCP_NODELAY"):
         sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if no_delay else 0)
     if tos is not None and hasattr(socket, "IP_TOS"):
         sock.setsockopt(socket.SOL_IP, socket.IP_TOS, tos)
+    if keepalive is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1 if keepalive else 0)
+    if keep_idle is not None and hasattr(socket, "TCP_KEEPIDLE"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, int(keep_idle))
+    if keep_interval is not None and hasattr(socket, "TCP_KEEPINTVL"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, int(keep_interval))
+    if keep_count is not None and hasattr(socket, "TCP_KEEPCNT"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, keep_count)
+    if user_timeout is not None and hasattr(socket, "TCP_USER_TIMEOUT"):
+        # seconds -> milliseconds
+        timeout = int(user_timeout * 1000)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, timeout)
+
+
+def client_options(cfg):
+    """setsockopt keyword arguments for the accepted clients"""
+    keys = (
+        "no_delay",
+        "tos",
+        "keepalive",
+        "keep_idle",
+        "keep_interval",
+        "keep_count",
+        "user_timeout",
+    )
+    return dict((key, cfg[key]) for key in keys)
+
+
+def is_alive(sock):
+    """False if the peer of the (non blocking) socket is known to be gone"""
+    try:
+        return sock.recv(1, socket.MSG_PEEK) != b""
+    except socket.error as error:
+        return error.errno in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+def cork(sock, on):
+    """
+    Hold back partial TCP segments until uncorked (Linux TCP_CORK).
+    Returns False if not supported on this platform
+    """
+    if not hasattr(socket, "TCP_CORK"):
+        return False
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1 if on else 0)
+    return True
 
 
 def create_server(
-    address, reuse_addr=True, no_delay=True, tos=IPTOS_LOWDELAY, listen=1
+    address, reuse_addr=True, no_delay=True, tos=IPTOS_LOWDELAY, listen=1, **kwargs
 ):
     server = socket.socket()
-    setsockopt(server, reuse_addr=reuse_addr, no_delay=no_delay, tos=tos)
+    setsockopt(server, reuse_addr=reuse_addr, no_delay=no_delay, tos=tos, **kwargs)
     server.bind(address)
     server.listen(listen)
     server.setblocking(False)
@@ -32,6 +100,110 @@ def create_server(
 def create_serial(config):
     config = dict(config)
     port = config.pop("port")
+    if hasattr(serial, "serial_for_url"):
+        return serial.serial_for_url(port, do_not_open=True, **config)
     ser = serial.Serial(**config)
     ser.port = port
     return ser
+
+
+def serial_fileno(ser):
+    """
+    File descriptor of an open native serial port, switched to non blocking
+    mode, or None if the port must be handled through pyserial (ex: URL
+    ports like socket:// or rfc2217://)
+    """
+    if os.name != "posix" or not hasattr(os, "readv") or "://" in (ser.port or ""):
+        return None
+    try:
+        fd = ser.fileno()
+    except (AttributeError, ValueError, OSError):
+        return None
+    import fcntl
+
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    return fd
+
+
+def readinto_fd(fd, buff):
+    """non blocking read. Returns number of bytes read (None if would block)"""
+    try:
+        return os.readv(fd, [buff])
+    except OSError as error:
+        if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return None
+        raise
+
+
+def send(sock, data):
+    """non blocking send. Returns number of bytes sent (0 if would block)"""
+    try:
+        return sock.send(data)
+    except socket.error as error:
+        if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return 0
+        raise
+
+
+def write_fd(fd, data):
+    """non blocking write. Returns number of bytes written (0 if would block)"""
+    try:
+        return os.write(fd, data)
+    except OSError as error:
+        if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return 0
+        raise
+
+
+def splice_supported():
+    return hasattr(os, "splice")
+
+
+class Pipe:
+    """
+    Kernel pipe used to move data between two file descriptors with
+    os.splice without it ever reaching user space
+    """
+
+    def __init__(self):
+        self.rfd, self.wfd = os.pipe()
+        os.set_blocking(self.rfd, False)
+        os.set_blocking(self.wfd, False)
+        self.flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        # number of bytes in the pipe
+        self.pending = 0
+
+    def fill(self, fd, size):
+        """splice up to size bytes from fd. Returns None if would block"""
+        try:
+            n = os.splice(fd, self.wfd, size, flags=self.flags)
+        except OSError as error:
+            if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return None
+            raise
+        self.pending += n
+        return n
+
+    def drain(self, fd):
+        """splice pending data into fd. Returns number of bytes moved"""
+        try:
+            n = os.splice(self.rfd, fd, self.pending, flags=self.flags)
+        except OSError as error:
+            if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            raise
+        self.pending -= n
+        return n
+
+    def read(self):
+        """read pending data into user space"""
+        data = bytearray()
+        while len(data) < self.pending:
+            data += os.read(self.rfd, self.pending - len(data))
+        self.pending = 0
+        return data
+
+    def close(self):
+        os.close(self.rfd)
+        os.close(self.wfd)
@@ -1,26 +1,119 @@
 import os
 import sys
-import runpy
+import logging
 
-import serial
+from .framing import LENGTH_PREFIX
 
 
-TCP_DEFAULTS = {
-    "reuse_addr": True,
-    "no_delay": True,
-    "tos": 0x10,
-    "listen": 1,
+# bridge options living in the tcp config which are not given to the socket
+TCP_BRIDGE_DEFAULTS = {
+    "buffer_size": 1024,
+    "high_water": 64 * 1024,
+    "low_water": 16 * 1024,
+    "zero_copy": False,
+    "max_clients": 1,
+    "slow_client": "pause",
+    # what to do with a new client when there are already max_clients
+    "takeover": "reject",
+    "takeover_idle": 60.0,
+    "mode": "stream",
+    # serial -> tcp coalescing: send when batch_size bytes are waiting or
+    # batch_delay seconds after the first byte (0 disables batching)
+    "batch_size": 4096,
+    "batch_delay": 0,
+    # transaction mode options
+    "request_terminator": b"\n",
+    "reply_terminator": b"\n",
+    "reply_size": None,
+    "reply_gap": None,
+    "reply_timeout": 1.0,
+    # requests (bytes or compiled regular expressions) whose replies are cached
+    "cache": (),
+    "cache_ttl": 1.0,
+    "cache_size": 128,
 }
 
 
-SERIAL_DEFAULTS = {
-    "baudrate": 9600,
-    "bytesize": serial.EIGHTBITS,
-    "parity": serial.PARITY_NONE,
-    "stopbits": serial.STOPBITS_ONE,
+SLOW_CLIENT_POLICIES = ("pause", "drop", "disconnect")
+
+
+TAKEOVER_POLICIES = ("reject", "replace_oldest", "replace_if_idle")
+
+
+MODES = ("stream", "transaction")
+
+
+OPEN_POLICIES = ("on_demand", "always_open", "idle_timeout")
+
+
+def to_bytes(value):
+    if value is None or isinstance(value, bytes):
+        return value
+    return value.encode("latin-1")
+
+
+TCP_DEFAULTS = dict(
+    {
+        "reuse_addr": True,
+        "no_delay": True,
+        "tos": 0x10,
+        "listen": 1,
+        # dead peer detection (None keeps the system defaults)
+        "keepalive": None,
+        "keep_idle": None,
+        "keep_interval": None,
+        "keep_count": None,
+        "user_timeout": None,
+    },
+    **TCP_BRIDGE_DEFAULTS
+)
+
+
+# bridge options living in the serial config which are not given to pyserial
+SERIAL_BRIDGE_DEFAULTS = {
+    "buffer_size": 4096,
+    "high_water": 64 * 1024,
+    "low_water": 16 * 1024,
+    # when to close the serial line once the last client leaves
+    "open_policy": "on_demand",
+    "idle_timeout": 60.0,
+    # reopen the serial line after a failure (ex: device unplugged)
+    "reconnect": False,
+    "reconnect_delay": 0.5,
+    "reconnect_max_delay": 30.0,
+    "keep_clients": False,
+    # stream mode framing of the data coming from the serial line
+    "frame_terminator": None,
+    "frame_size": None,
+    "frame_length_prefix": None,
+    "frame_gap": None,
+    "frame_max": 64 * 1024,
+    # fair scheduling: bytes read from the serial line per loop iteration
+    # and per unit of weight (None: drain everything available). Ready
+    # bridges with a higher priority are served first (selector engine)
+    "read_budget": None,
+    "weight": 1,
+    "priority": 0,
+    # record the traffic in a memory mapped ring file (see capture.Capture)
+    "capture": False,
+    "capture_size": 1024 * 1024,
+    "capture_rotate": 0,
 }
 
 
+SERIAL_DEFAULTS = dict(
+    {
+        "baudrate": 9600,
+        # serial.EIGHTBITS, serial.PARITY_NONE and serial.STOPBITS_ONE (pyserial
+        # is not imported here to keep the configuration path light)
+        "bytesize": 8,
+        "parity": "N",
+        "stopbits": 1,
+    },
+    **SERIAL_BRIDGE_DEFAULTS
+)
+
+
 def tcp_config(**kwargs):
     kwargs["__kind__"] = "tcp"
     return kwargs
@@ -48,11 +141,74 @@ def to_tcp_address(addr):
 def to_tcp(cfg):
     result = dict(TCP_DEFAULTS, **cfg)
     result["address"] = to_tcp_address(cfg["address"])
+    if result["slow_client"] not in SLOW_CLIENT_POLICIES:
+        msg = "unknown slow_client policy {0!r} (expected one of {1})".format(
+            result["slow_client"], SLOW_CLIENT_POLICIES
+        )
+        raise ValueError(msg)
+    if result["takeover"] not in TAKEOVER_POLICIES:
+        msg = "unknown takeover policy {0!r} (expected one of {1})".format(
+            result["takeover"], TAKEOVER_POLICIES
+        )
+        raise ValueError(msg)
+    if result["max_clients"] < 1:
+        raise ValueError("max_clients must be >= 1")
+    if result["batch_size"] < 1:
+        raise ValueError("batch_size must be >= 1")
+    if result["mode"] not in MODES:
+        msg = "unknown mode {0!r} (expected one of {1})".format(result["mode"], MODES)
+        raise ValueError(msg)
+    for key in ("request_terminator", "reply_terminator"):
+        result[key] = to_bytes(result[key])
+    if result["mode"] == "transaction" and not result["request_terminator"]:
+        # requests could never be told apart: nothing would be forwarded
+        raise ValueError("transaction mode requires a request_terminator")
+    result["cache"] = tuple(
+        to_bytes(item) if isinstance(item, str) else item for item in result["cache"]
+    )
+    if result["cache"] and result["mode"] != "transaction":
+        raise ValueError("cache is only supported in transaction mode")
     return result
 
 
 def to_serial(cfg):
-    return dict(SERIAL_DEFAULTS, **cfg)
+    result = dict(SERIAL_DEFAULTS, **cfg)
+    if result["open_policy"] not in OPEN_POLICIES:
+        msg = "unknown open_policy {0!r} (expected one of {1})".format(
+            result["open_policy"], OPEN_POLICIES
+        )
+        raise ValueError(msg)
+    result["frame_terminator"] = to_bytes(result["frame_terminator"])
+    if result["read_budget"] is not None and result["read_budget"] < 1:
+        msg = "read_budget must be >= 1 (got {0!r})".format(result["read_budget"])
+        raise ValueError(msg)
+    if result["weight"] < 1:
+        raise ValueError("weight must be >= 1 (got {0!r})".format(result["weight"]))
+    if result["capture_size"] < 4096:
+        msg = "capture_size must be >= 4096 (got {0!r})".format(result["capture_size"])
+        raise ValueError(msg)
+    prefix = result["frame_length_prefix"]
+    if prefix and not LENGTH_PREFIX.match(prefix):
+        msg = (
+            "invalid frame_length_prefix {0!r} (expected a single unsigned "
+            "integer struct format, ex: '>H')".format(prefix)
+        )
+        raise ValueError(msg)
+    return result
+
+
+def tcp_options(cfg):
+    """create_server keyword arguments of a bridge tcp configuration"""
+    return dict(
+        (key, value) for key, value in cfg.items() if key not in TCP_BRIDGE_DEFAULTS
+    )
+
+
+def serial_options(cfg):
+    """pyserial keyword arguments of a bridge serial configuration"""
+    return dict(
+        (key, value) for key, value in cfg.items() if key not in SERIAL_BRIDGE_DEFAULTS
+    )
 
 
 def to_bridge(cfg):
@@ -61,21 +217,291 @@ def to_bridge(cfg):
         serial, tcp = (a, b) if a.pop("__kind__") == "serial" else (b, a)
         b.pop("__kind__")
         cfg = dict(serial=serial, tcp=tcp)
+    else:
+        # serial() and tcp() helpers may also be used in the dict form
+        cfg["serial"].pop("__kind__", None)
+        cfg["tcp"].pop("__kind__", None)
     cfg["tcp"] = to_tcp(cfg["tcp"])
     cfg["serial"] = to_serial(cfg["serial"])
     return cfg
 
 
+def bridge_id(cfg):
+    """stable identity of a bridge: its name if given or its serial port"""
+    return cfg.get("name") or cfg["serial"]["port"]
+
+
+ENGINES = ("selector", "asyncio")
+
+
 def sanitize_config(config):
+    engine = config.get("engine", "selector")
+    if engine not in ENGINES:
+        msg = "unknown engine {0!r} (expected one of {1})".format(engine, ENGINES)
+        raise ValueError(msg)
+    workers = int(config.get("workers", 1))
+    if workers < 1:
+        raise ValueError("workers must be >= 1 (got {0})".format(workers))
+    bridges = [to_bridge(bridge) for bridge in config.get("bridges", ())]
+    ids = [bridge_id(bridge) for bridge in bridges]
+    for bid in set(ids):
+        if ids.count(bid) > 1:
+            msg = "duplicate bridge {0!r} (give bridges a unique name)".format(bid)
+            raise ValueError(msg)
     return dict(
-        bridges=[to_bridge(bridge) for bridge in config.get("bridges", ())],
+        bridges=bridges,
         web=to_tcp_address(config["web"]) if "web" in config else None,
+        engine=engine,
+        workers=workers,
+        watch=float(config.get("watch", 0)),
+        # only the web UI serves the metrics
+        metrics=float(config.get("metrics", 5 if "web" in config else 0)),
+        slow_callback=float(config.get("slow_callback", 0)),
+        stats=config.get("stats"),
+        stats_interval=float(config.get("stats_interval", 1)),
+        capture_dir=config.get("capture_dir"),
     )
 
 
-def load_config(filename):
+NUMBER = (int, float)
+TEXT = (str, bytes)
+OPTIONAL = (type(None),)
+
+
+# accepted types of each declarative (JSON/TOML) option. None is only
+# accepted where it means "disabled" or "system default"
+SERIAL_TYPES = {
+    # pyserial keyword arguments
+    "port": str,
+    "baudrate": int,
+    "bytesize": int,
+    "parity": str,
+    "stopbits": NUMBER,
+    "timeout": NUMBER + OPTIONAL,
+    "xonxoff": bool,
+    "rtscts": bool,
+    "dsrdtr": bool,
+    "write_timeout": NUMBER + OPTIONAL,
+    "inter_byte_timeout": NUMBER + OPTIONAL,
+    "exclusive": (bool,) + OPTIONAL,
+    # bridge options
+    "buffer_size": int,
+    "high_water": int,
+    "low_water": int,
+    "open_policy": str,
+    "idle_timeout": NUMBER,
+    "reconnect": bool,
+    "reconnect_delay": NUMBER,
+    "reconnect_max_delay": NUMBER,
+    "keep_clients": bool,
+    "frame_terminator": TEXT + OPTIONAL,
+    "frame_size": (int,) + OPTIONAL,
+    "frame_length_prefix": (str,) + OPTIONAL,
+    "frame_gap": NUMBER + OPTIONAL,
+    "frame_max": int,
+    "read_budget": (int,) + OPTIONAL,
+    "weight": NUMBER,
+    "priority": int,
+    "capture": bool,
+    "capture_size": int,
+    "capture_rotate": int,
+}
+
+
+TCP_TYPES = {
+    "address": (str, list),
+    "reuse_addr": bool,
+    "no_delay": bool,
+    "tos": int,
+    "listen": int,
+    "keepalive": (bool,) + OPTIONAL,
+    "keep_idle": NUMBER + OPTIONAL,
+    "keep_interval": NUMBER + OPTIONAL,
+    "keep_count": (int,) + OPTIONAL,
+    "user_timeout": NUMBER + OPTIONAL,
+    "buffer_size": int,
+    "high_water": int,
+    "low_water": int,
+    "zero_copy": bool,
+    "max_clients": int,
+    "slow_client": str,
+    "takeover": str,
+    "takeover_idle": NUMBER,
+    "mode": str,
+    "batch_size": int,
+    "batch_delay": NUMBER,
+    "request_terminator": TEXT + OPTIONAL,
+    "reply_terminator": TEXT + OPTIONAL,
+    "reply_size": (int,) + OPTIONAL,
+    "reply_gap": NUMBER + OPTIONAL,
+    "reply_timeout": NUMBER,
+    "cache": list,
+    "cache_ttl": NUMBER,
+    "cache_size": int,
+}
+
+
+BRIDGE_TYPES = {"name": str, "serial": dict, "tcp": dict}
+
+
+CONFIG_TYPES = {
+    "bridges": list,
+    "web": (str, list),
+    "engine": str,
+    "workers": int,
+    "watch": NUMBER,
+    "metrics": NUMBER,
+    "slow_callback": NUMBER,
+    "stats": str,
+    "stats_interval": NUMBER,
+    "capture_dir": str,
+}
+
+
+def _check_types(where, cfg, types):
+    unknown = sorted(set(cfg) - set(types))
+    if unknown:
+        msg = "{0}: unknown option(s) {1}".format(where, ", ".join(unknown))
+        raise ValueError(msg)
+    for key, value in cfg.items():
+        expected = types[key]
+        if not isinstance(expected, tuple):
+            expected = (expected,)
+        # bool is an int subclass but true/false is not a valid number
+        ok = isinstance(value, expected) and (
+            bool in expected or not isinstance(value, bool)
+        )
+        if not ok:
+            names = " or ".join(
+                "null" if kind is type(None) else kind.__name__ for kind in expected
+            )
+            msg = "{0}: {1} must be of type {2} (got {3!r})".format(
+                where, key, names, value
+            )
+            raise ValueError(msg)
+
+
+def validate_config(config):
+    """
+    Strict validation of a declarative (JSON/TOML) configuration: unknown
+    options and values of the wrong type are rejected (ValueError)
+    """
+    if not isinstance(config, dict):
+        raise ValueError("config: must be a table/object")
+    _check_types("config", config, CONFIG_TYPES)
+    for index, bridge in enumerate(config.get("bridges", ())):
+        where = "bridge #{0}".format(index)
+        if not isinstance(bridge, dict):
+            raise ValueError("{0}: must be a table/object".format(where))
+        _check_types(where, bridge, BRIDGE_TYPES)
+        for domain, types in (("serial", SERIAL_TYPES), ("tcp", TCP_TYPES)):
+            if domain not in bridge:
+                raise ValueError("{0}: missing {1}".format(where, domain))
+            _check_types("{0} {1}".format(where, domain), bridge[domain], types)
+        if "port" not in bridge["serial"] or "address" not in bridge["tcp"]:
+            msg = "{0}: serial port and tcp address are mandatory".format(where)
+            raise ValueError(msg)
+
+
+def read_declarative(filename):
+    if filename.endswith(".json"):
+        import json
+
+        with open(filename) as fobj:
+            return json.load(fobj)
+    try:
+        import tomllib
+    except ImportError:  # python < 3.11
+        import tomli as tomllib
+    with open(filename, "rb") as fobj:
+        return tomllib.load(fobj)
+
+
+def cache_dir():
+    return os.environ.get("SER2SOCK_CACHE_DIR") or os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+        "ser2sock",
+    )
+
+
+def _cache_key(data):
+    import hashlib
+
+    from . import __version__
+
+    # validation depends on the ser2sock version (and on this very module
+    # when running from a source tree)
+    digest = hashlib.sha256(data)
+    digest.update(__version__.encode())
+    with open(__file__, "rb") as fobj:
+        digest.update(fobj.read())
+    return digest.hexdigest()
+
+
+def is_private(info):
+    """
+    True if the file or directory (os.stat result) belongs to the current
+    user and cannot be modified by anybody else
+    """
+    if hasattr(os, "getuid") and info.st_uid != os.getuid():
+        return False
+    return not info.st_mode & 0o022
+
+
+def _read_cache(cache_file):
+    """cached document or None. Files others could have tampered with are ignored"""
+    import json
+
+    try:
+        with open(cache_file) as fobj:
+            if not is_private(os.fstat(fobj.fileno())):
+                return None
+            return json.load(fobj)
+    except (OSError, IOError, ValueError):
+        return None
+
+
+def _write_cache(cache_file, config):
+    import json
+
+    try:
+        if not os.path.isdir(cache_dir()):
+            os.makedirs(cache_dir(), 0o700)
+        tmp = "{0}.{1}".format(cache_file, os.getpid())
+        with open(tmp, "w") as fobj:
+            os.chmod(tmp, 0o600)
+            json.dump(config, fobj)
+        os.rename(tmp, cache_file)
+    except (OSError, IOError) as error:
+        logging.debug("could not cache configuration: %r", error)
+
+
+def load_declarative(filename):
+    """
+    Load a JSON or TOML configuration. The validated TOML document is
+    cached on disk as JSON (keyed by the file contents hash) so that it
+    does not need to be parsed and validated again. Normalization
+    (sanitize_config) always runs
+    """
+    if filename.endswith(".json"):
+        config = read_declarative(filename)
+        validate_config(config)
+        return sanitize_config(config)
+    with open(filename, "rb") as fobj:
+        data = fobj.read()
+    cache_file = os.path.join(cache_dir(), _cache_key(data) + ".json")
+    config = _read_cache(cache_file)
+    if config is None:
+        config = read_declarative(filename)
+        validate_config(config)
+        _write_cache(cache_file, config)
+    return sanitize_config(config)
+
+
+def load_python(filename):
+    import runpy
+
     glob = dict(serial=serial_config, tcp=tcp_config)
-    full = os.path.abspath(filename)
     path, fname = os.path.split(filename)
     mod_name, _ = os.path.splitext(fname)
     sys.path.insert(0, path)
@@ -86,6 +512,21 @@ def load_config(filename):
     return sanitize_config(config)
 
 
+DECLARATIVE_EXTENSIONS = (".json", ".toml")
+
+
+def load_config(filename):
+    """load a python, JSON or TOML (depending on the extension) configuration"""
+    filename = str(filename)
+    if filename.endswith(DECLARATIVE_EXTENSIONS):
+        config = load_declarative(filename)
+    else:
+        config = load_python(filename)
+    # remembered to reload it later (see Server.reload)
+    config["filename"] = os.path.abspath(filename)
+    return config
+
+
 def human_size(n):
     for i in " kMGTPEZY":
         if n / 1000 < 1:
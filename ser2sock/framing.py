@@ -0,0 +1,106 @@
+import re
+import struct
+
+# single unsigned integer struct format
+LENGTH_PREFIX = re.compile(r"^[<>!=]?[BHILQ]$")
+
+
+class Framer:
+    """
+    Splits a byte stream into frames. The base class never finds a frame
+    boundary by itself: frames are only delimited by the caller with
+    flush() (ex: after an idle gap on the line).
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def _split(self):
+        return []
+
+    def feed(self, data):
+        """add data and return the list of complete frames"""
+        self.buffer += data
+        return self._split()
+
+    def flush(self):
+        """return whatever is buffered as a frame"""
+        frame = bytes(self.buffer)
+        del self.buffer[:]
+        return frame
+
+
+class TerminatorFramer(Framer):
+    """frames end with terminator (included in the frame)"""
+
+    def __init__(self, terminator):
+        Framer.__init__(self)
+        self.terminator = terminator
+
+    def _split(self):
+        frames, buff, term = [], self.buffer, self.terminator
+        start = 0
+        while True:
+            end = buff.find(term, start)
+            if end < 0:
+                break
+            end += len(term)
+            frames.append(bytes(buff[start:end]))
+            start = end
+        del buff[:start]
+        return frames
+
+
+class SizeFramer(Framer):
+    """frames of a fixed size"""
+
+    def __init__(self, size):
+        Framer.__init__(self)
+        self.size = size
+
+    def _split(self):
+        buff, size = self.buffer, self.size
+        n = len(buff) - len(buff) % size
+        frames = [bytes(buff[i : i + size]) for i in range(0, n, size)]
+        del buff[:n]
+        return frames
+
+
+class LengthPrefixFramer(Framer):
+    """
+    frames start with their payload length encoded with the struct format
+    prefix (ex: ">H"). The prefix is included in the frame.
+    """
+
+    def __init__(self, prefix):
+        Framer.__init__(self)
+        if not LENGTH_PREFIX.match(prefix):
+            msg = "prefix must be a single unsigned integer (got {0!r})".format(prefix)
+            raise ValueError(msg)
+        self.prefix = struct.Struct(prefix)
+
+    def _split(self):
+        frames, buff, prefix = [], self.buffer, self.prefix
+        start = 0
+        while len(buff) - start >= prefix.size:
+            (length,) = prefix.unpack_from(buff, start)
+            end = start + prefix.size + length
+            if end > len(buff):
+                break
+            frames.append(bytes(buff[start:end]))
+            start = end
+        del buff[:start]
+        return frames
+
+
+def create_framer(terminator=None, size=None, length_prefix=None):
+    if terminator:
+        return TerminatorFramer(terminator)
+    elif size:
+        return SizeFramer(size)
+    elif length_prefix:
+        return LengthPrefixFramer(length_prefix)
+    return Framer()
@@ -21,6 +21,10 @@
 		  <th colspan="1" scope="col">tcp</th>
 		  <th colspan="3" scope="col">client</th>
 		  <th colspan="2" scope="col">traffic</th>
+		  <th colspan="2" scope="col">buffered</th>
+		  <th rowspan="2" scope="col">frames</th>
+		  <th colspan="2" scope="col">cache</th>
+		  <th rowspan="2" scope="col">capture</th>
 		</tr>
 		<tr>
 		  <th scope="col">port</th>
@@ -34,9 +38,13 @@
 		  <th scope="col">history</th>
 		  <th scope="col">tcp->sl</th>
 		  <th scope="col">sl->tcp</th>
+		  <th scope="col">tcp->sl</th>
+		  <th scope="col">sl->tcp</th>
+		  <th scope="col">hits</th>
+		  <th scope="col">misses</th>
 		</tr>
 	      </thead>
-	      % for idx, bridge in enumerate(server.bridges):
+	      % for idx, bridge in enumerate(bridges):
 	      % serial, tcp = bridge.config['serial'], bridge.config['tcp']
 	      % baudrate = serial['baudrate']
 	      % bytesize = serial['bytesize']
@@ -48,6 +56,15 @@
 		  <input type="text" name="serial-port-{{idx}}"
 			 value="{{ serial['port'] }}"
 			 class="form-control form-control-sm"/>
+		  <small class="text-muted">
+		    {{ bridge.serial_state }}
+		    % if bridge.serial_state == "reconnecting":
+		    (attempt {{ bridge.reconnect_attempts + 1 }})
+		    % end
+		    % if bridge.serial_losses:
+		    &middot; lost {{ bridge.serial_losses }}x
+		    % end
+		  </small>
 		</td>
 		<td>
 		  <select name="serial-baudrate-{{idx}}"
@@ -87,9 +104,10 @@
 			 class="form-control form-control-sm" />
 		</td>
 		<td align="center">
-		  % if bridge.client:
-		  {{ '{}:{}'.format(*bridge.client.getpeername()) }}
-		  <!-- <button>close</button> -->
+		  % if bridge.client_addrs:
+		  % for client_addr in bridge.client_addrs:
+		  {{ '{}:{}'.format(*client_addr) }}<br/>
+		  % end
 		  % else:
 		  -
 		  % end
@@ -116,6 +134,32 @@
 		  -
 		  % end
 		</td>
+		<td align="center">
+		  {{ '{:.3f} {}B'.format(*human_size(bridge.serial_buffered)) }}
+		</td>
+		<td align="center">
+		  {{ '{:.3f} {}B'.format(*human_size(bridge.client_buffered)) }}
+		</td>
+		<td align="center">
+		  {{ bridge.serial_frames or '-' }}
+		</td>
+		<td align="center">
+		  {{ '-' if bridge.cache_hits is None else bridge.cache_hits }}
+		</td>
+		<td align="center">
+		  {{ '-' if bridge.cache_misses is None else bridge.cache_misses }}
+		</td>
+		<td>
+		  <select name="serial-capture-{{idx}}"
+			  class="form-control form-control-sm">
+		    % for value in ['off', 'on']:
+		    <option {{ "selected" if (value == 'on') == serial['capture'] else "" }}>{{value}}</option>
+		    % end
+		  </select>
+		  % if bridge.capture_file:
+		  <small class="text-muted">{{ bridge.capture_file }}</small>
+		  % end
+		</td>
 	      </tr>
 	      % end
 	    </table>
@@ -123,6 +167,42 @@
 	  </form>
 	</div>
       </div>
+      % if loop:
+      <div class="card">
+	<div class="card-header text-center">event loop</div>
+	<div class="card-body">
+	  <p class="text-muted">
+	    {{ loop['iterations'] }} iterations
+	    &middot; max lag {{ '{:.3f}'.format(loop['lag_max'] * 1000) }} ms
+	    &middot; max timer lag {{ '{:.3f}'.format(loop['timer_lag_max'] * 1000) }} ms
+	    &middot; {{ loop['slow'] }} callbacks slower than
+	    {{ '{:.3f}'.format(loop['slow_callback'] * 1000) }} ms
+	  </p>
+	  % for title, table in (('callback', loop['callbacks']), ('bridge', loop['bridges'])):
+	  <table class="table table-striped table-sm">
+	    <thead class="thead-light">
+	      <tr>
+		<th scope="col">{{ title }}</th>
+		<th scope="col">calls</th>
+		<th scope="col">total (ms)</th>
+		<th scope="col">mean (ms)</th>
+		<th scope="col">max (ms)</th>
+	      </tr>
+	    </thead>
+	    % for name, stats in sorted(table.items(), key=lambda item: -item[1]['total']):
+	    <tr>
+	      <td>{{ name }}</td>
+	      <td>{{ stats['count'] }}</td>
+	      <td>{{ '{:.3f}'.format(stats['total'] * 1000) }}</td>
+	      <td>{{ '{:.3f}'.format(stats['total'] * 1000 / stats['count']) }}</td>
+	      <td>{{ '{:.3f}'.format(stats['max'] * 1000) }}</td>
+	    </tr>
+	    % end
+	  </table>
+	  % end
+	</div>
+      </div>
+      % end
     </div>
   </body>
 </html>
@@ -0,0 +1,184 @@
+import time
+import bisect
+import logging
+
+from .comm import monotonic
+from .config import bridge_id
+
+
+# latency buckets (seconds)
+LATENCY_BOUNDS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# cumulative counters of Bridge.status from which rates are computed
+RATES = (
+    ("client_bytes", "tcp_to_serial_bytes"),
+    ("serial_bytes", "serial_to_tcp_bytes"),
+    ("client_reads", "tcp_to_serial_reads"),
+    ("serial_reads", "serial_to_tcp_reads"),
+    ("client_nb", "connections"),
+)
+
+COUNTERS = (
+    ("client_bytes", "bytes received from the clients"),
+    ("serial_bytes", "bytes received from the serial line"),
+    ("client_reads", "reads from the clients"),
+    ("serial_reads", "reads from the serial line"),
+    ("client_nb", "client connections"),
+    ("client_dropped", "bytes dropped for slow clients"),
+    ("client_errors", "clients dropped because of an error"),
+    ("serial_losses", "serial line failures"),
+    ("transactions", "transactions (transaction mode)"),
+    ("timeouts", "transactions without reply (transaction mode)"),
+)
+
+GAUGES = (
+    ("client_buffered", "bytes waiting to be sent to the clients"),
+    ("serial_buffered", "bytes waiting to be written to the serial line"),
+    ("reconnect_attempts", "current serial reconnection attempts"),
+)
+
+
+class Histogram:
+    """Fixed bucket histogram (bounds are the bucket upper limits)"""
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        # last bucket is +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def state(self):
+        """picklable copy (see Bridge.status)"""
+        return dict(
+            bounds=self.bounds, counts=list(self.counts), sum=self.sum, count=self.count
+        )
+
+
+def _label(value):
+    value = str(value)
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """
+    Samples the bridges of a server every interval seconds (in the event
+    loop) and precomputes the /api/status (JSON) and /metrics (Prometheus)
+    documents so that serving them costs nothing to the bridges
+    """
+
+    def __init__(self, server, interval):
+        self.server = server
+        self.interval = interval
+        self.previous = {}
+        self.last = None
+        self.json = "{}"
+        self.text = ""
+        self.timer = None
+
+    def start(self):
+        self.sample()
+        self.timer = self.server.call_every(self.interval, self.sample)
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def sample(self):
+        try:
+            self._sample()
+        except Exception:
+            logging.exception("error sampling metrics")
+
+    def _sample(self):
+        import json
+
+        now = monotonic()
+        elapsed = now - self.last if self.last is not None else None
+        self.last = now
+        bridges, previous = [], {}
+        for bridge in self.server.snapshot():
+            bid = bridge_id(bridge.config)
+            counters = dict((name, getattr(bridge, name) or 0) for name, _ in COUNTERS)
+            rates = {}
+            old = self.previous.get(bid)
+            for name, rate in RATES:
+                if old is None or not elapsed:
+                    rates[rate] = 0.0
+                else:
+                    rates[rate] = max(0, counters[name] - old[name]) / elapsed
+            previous[bid] = counters
+            bridges.append(
+                dict(
+                    id=bid,
+                    port=bridge.config["serial"]["port"],
+                    address=bridge.config["tcp"]["address"],
+                    state=bridge.serial_state,
+                    clients=len(bridge.client_addrs or ()),
+                    counters=counters,
+                    rates=rates,
+                    queues=dict(
+                        (name, getattr(bridge, name) or 0) for name, _ in GAUGES
+                    ),
+                    latency=bridge.latency or {},
+                )
+            )
+        self.previous = previous
+        self.json = json.dumps(dict(time=time.time(), bridges=bridges))
+        self.text = to_prometheus(bridges)
+
+
+def to_prometheus(bridges):
+    lines = []
+
+    def add(name, kind, help, samples):
+        lines.append("# HELP ser2sock_{0} {1}".format(name, help))
+        lines.append("# TYPE ser2sock_{0} {1}".format(name, kind))
+        for labels, value in samples:
+            labels = ",".join('{0}="{1}"'.format(k, _label(v)) for k, v in labels)
+            lines.append("ser2sock_{0}{{{1}}} {2}".format(name, labels, value))
+
+    for name, help in COUNTERS:
+        samples = [((("bridge", b["id"]),), b["counters"][name]) for b in bridges]
+        add(name + "_total", "counter", help, samples)
+    for name, rate in RATES:
+        samples = [((("bridge", b["id"]),), b["rates"][rate]) for b in bridges]
+        help = rate.replace("_", " ") + " per second"
+        add(rate + "_per_second", "gauge", help, samples)
+    for name, help in GAUGES:
+        samples = [((("bridge", b["id"]),), b["queues"][name]) for b in bridges]
+        add(name, "gauge", help, samples)
+    samples = [
+        ((("bridge", b["id"]), ("state", b["state"])), 1)
+        for b in bridges
+        if b["state"] is not None
+    ]
+    add("serial_state", "gauge", "serial line state", samples)
+    lines.append("# HELP ser2sock_latency_seconds time spent inside ser2sock")
+    lines.append("# TYPE ser2sock_latency_seconds histogram")
+    for bridge in bridges:
+        for path, hist in sorted(bridge["latency"].items()):
+            labels = 'bridge="{0}",path="{1}"'.format(_label(bridge["id"]), path)
+            total = 0
+            for bound, count in zip(hist["bounds"] + ("+Inf",), hist["counts"]):
+                total += count
+                lines.append(
+                    'ser2sock_latency_seconds_bucket{{{0},le="{1}"}} {2}'.format(
+                        labels, bound, total
+                    )
+                )
+            lines.append(
+                "ser2sock_latency_seconds_sum{{{0}}} {1}".format(labels, hist["sum"])
+            )
+            lines.append(
+                "ser2sock_latency_seconds_count{{{0}}} {1}".format(
+                    labels, hist["count"]
+                )
+            )
+    return "\n".join(lines) + "\n"
@@ -1,10 +1,11 @@
 import os
 import sys
-import runpy
+import heapq
+import functools
 import socket
-import select
 import logging
-import optparse
+import threading
+import collections
 
 PY2 = sys.version_info[0] == 2
 
@@ -13,71 +14,464 @@ if PY2:
 else:
     import selectors
 
-import serial
+from .bridge import Bridge, BridgeStatus, prepare_bridge, release_bridge
+from .comm import monotonic, TimeoutError
+from .config import load_config, to_bridge, bridge_id, ENGINES
 
-from .bridge import Bridge
-from .config import load_config, to_bridge
+
+class Timer:
+    """Handle of a callback scheduled with Server.call_later/call_at"""
+
+    __slots__ = ("when", "callback", "cancelled", "server")
+
+    def __init__(self, when, callback, server=None):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+        # server holding the timer in its heap (None once it has been run)
+        self.server = server
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.server is not None:
+            self.server._timer_cancelled()
+            self.server = None
+
+
+class PeriodicTimer:
+    """Handle of a callback scheduled with Server.call_every"""
+
+    def __init__(self, server, interval, callback):
+        self.server = server
+        self.interval = interval
+        self.callback = callback
+        self.cancelled = False
+        self.when = monotonic() + interval
+        self.timer = server.call_at(self.when, self._run)
+
+    def _run(self):
+        # next deadline is computed from the previous one to avoid drifting.
+        # Missed deadlines (callback slower than interval) are skipped
+        self.when = max(self.when + self.interval, monotonic())
+        self.timer = self.server.call_at(self.when, self._run)
+        self.callback()
+
+    def cancel(self):
+        self.cancelled = True
+        self.timer.cancel()
+
+
+class LoopProfiler:
+    """
+    Cumulative and max duration of the callbacks run by the event loop,
+    per callback and per bridge, and lag of the loop iterations. Callbacks
+    slower than slow_callback seconds are logged (see Server.enable_profiling)
+    """
+
+    def __init__(self, slow_callback=0.1):
+        self.slow_callback = slow_callback
+        self.callbacks = {}
+        self.bridges = {}
+        self.iterations = 0
+        # time between select() returning and the end of the iteration,
+        # ie, how late the last ready file descriptor was served
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+        # how late timers run compared to their deadline
+        self.timer_lag_max = 0.0
+        self.slow = 0
+
+    def run(self, callback):
+        start = monotonic()
+        try:
+            callback()
+        finally:
+            self.record(callback, monotonic() - start)
+
+    def iteration(self, lag):
+        self.iterations += 1
+        self.lag_total += lag
+        if lag > self.lag_max:
+            self.lag_max = lag
+
+    def timer(self, lag):
+        if lag > self.timer_lag_max:
+            self.timer_lag_max = lag
+
+    def record(self, callback, elapsed):
+        name, bid = self.describe(callback)
+        _accumulate(self.callbacks, name, elapsed)
+        if bid is not None:
+            _accumulate(self.bridges, bid, elapsed)
+        if elapsed > self.slow_callback:
+            self.slow += 1
+            where = "" if bid is None else " (bridge {0!r})".format(bid)
+            logging.warning("slow callback %s%s took %.3fs", name, where, elapsed)
+
+    @staticmethod
+    def describe(callback):
+        """callback name and id of the bridge it belongs to (or None)"""
+        func, _ = _callback_owner(callback)
+        name = getattr(func, "__qualname__", None) or repr(func)
+        bridge = callback_bridge(callback)
+        if bridge is not None:
+            return name, bridge_id(bridge.config)
+        return name, None
+
+    def stats(self):
+        def copy(table):
+            return dict(
+                (key, dict(count=count, total=total, max=max_))
+                for key, (count, total, max_) in table.items()
+            )
+
+        return dict(
+            slow_callback=self.slow_callback,
+            iterations=self.iterations,
+            lag_total=self.lag_total,
+            lag_max=self.lag_max,
+            timer_lag_max=self.timer_lag_max,
+            slow=self.slow,
+            callbacks=copy(self.callbacks),
+            bridges=copy(self.bridges),
+        )
+
+
+def _callback_owner(callback):
+    func = getattr(callback, "func", callback)  # functools.partial
+    owner = getattr(func, "__self__", None)
+    if isinstance(owner, PeriodicTimer):
+        func = owner.callback
+        owner = getattr(func, "__self__", None)
+    return func, owner
+
+
+def callback_bridge(callback):
+    """bridge a loop callback belongs to (or None)"""
+    _, owner = _callback_owner(callback)
+    # ex: Arbiter timers belong to the bridge of the arbiter
+    bridge = owner if isinstance(owner, Bridge) else getattr(owner, "bridge", None)
+    return bridge if isinstance(bridge, Bridge) else None
+
+
+def _event_priority(event):
+    for callback in event[0].data.values():
+        bridge = callback_bridge(callback)
+        if bridge is not None:
+            return bridge.config["serial"]["priority"]
+    return 0
+
+
+def _accumulate(table, key, elapsed):
+    stats = table.get(key)
+    if stats is None:
+        table[key] = [1, elapsed, elapsed]
+        return
+    stats[0] += 1
+    stats[1] += elapsed
+    if elapsed > stats[2]:
+        stats[2] = elapsed
 
 
 class Server:
 
     shutdown_message = b"shutdown"
+    reload_message = b"reload"
+    call_message = b"call"
 
     def __init__(self, config):
         self.config = config
-        self.selector = selectors.DefaultSelector()
+        self.selector = self._new_selector()
+        # heap of Timer. Cancelled timers are left in place and skipped,
+        # the heap is compacted when they become the majority
+        self._timers = []
+        self._cancelled_timers = 0
+        # precomputed /metrics and /api/status documents (see metrics.Metrics)
+        self.metrics = None
+        # see enable_profiling
+        self.profiler = None
+        # memory mapped statistics file (see shm.StatsWriter)
+        self.stats_writer = None
+        # some bridge has a priority: sort ready events (see step)
+        self._prioritized = False
 
     def __enter__(self):
         logging.info("Bootstraping bridges...")
+        if self.config.get("slow_callback"):
+            self.enable_profiling(self.config["slow_callback"])
         self._make_self_channel()
         self._make_bridges()
         self.run_flag = True
+        self._watch_config()
+        self._start_metrics()
+        self._start_stats()
         logging.info("Ready to accept requests!")
         return self
 
     def __exit__(self, exc_type, exc_value, tb):
         self.close()
 
+    def _new_selector(self):
+        return selectors.DefaultSelector()
+
     def close(self):
+        self._close_stats()
         for bridge in self.bridges:
             bridge.close()
         self._close_self_channel()
         self.selector.close()
 
     def _make_bridges(self):
-        self.bridges = [Bridge(config, self) for config in self.config["bridges"]]
+        configs = self.config["bridges"]
+        if len(configs) > 1:
+            # opening serial lines and sockets may block: do it in parallel
+            from multiprocessing.pool import ThreadPool
+
+            pool = ThreadPool(min(len(configs), 32))
+            try:
+                pending = [
+                    pool.apply_async(prepare_bridge, (config,)) for config in configs
+                ]
+                calls = [result.get for result in pending]
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            calls = [functools.partial(prepare_bridge, config) for config in configs]
+        resources, errors = [], []
+        for call in calls:
+            try:
+                resources.append(call())
+            except Exception as error:
+                errors.append(error)
+        if errors:
+            # do not leak the sockets and serial lines of the other bridges
+            for res in resources:
+                release_bridge(res)
+            raise errors[0]
+        self.bridges = [
+            Bridge(config, self, res) for config, res in zip(configs, resources)
+        ]
+        self._update_priorities()
+
+    def _update_priorities(self):
+        self._prioritized = any(
+            bridge.config["serial"]["priority"] for bridge in self.bridges
+        )
 
     def _make_self_channel(self):
+        # callbacks scheduled from other threads (see call_soon_threadsafe)
+        self._calls = collections.deque()
+        self._calls_lock = threading.Lock()
         self._ssock, self._csock = socket.socketpair()
         self._ssock.setblocking(False)
         self._csock.setblocking(False)
         self.add_reader(self._ssock, self._on_internal_event)
 
     def _close_self_channel(self):
+        if self._ssock is None:
+            return
         self.remove_reader(self._ssock)
         self._ssock.close()
         self._ssock = None
         self._csock.close()
         self._csock = None
 
-    def _on_internal_event(self, fd):
-        data = fd.recv(4096)
-        if data == self.shutdown_message:
+    def _on_internal_event(self):
+        data = self._ssock.recv(4096)
+        with self._calls_lock:
+            calls, self._calls = self._calls, collections.deque()
+        for call in calls:
+            try:
+                call()
+            except Exception:
+                logging.exception("error in %r", call)
+        if self.reload_message in data:
+            self.reload()
+        if self.shutdown_message in data:
             self.run_flag = False
 
+    def _watch_config(self):
+        filename = self.config.get("filename")
+        if not self.config.get("watch") or not filename:
+            return
+        self._config_mtime = os.stat(filename).st_mtime
+        self.call_every(self.config["watch"], self._check_config)
+
+    def _check_config(self):
+        try:
+            mtime = os.stat(self.config["filename"]).st_mtime
+        except OSError as error:
+            logging.warning("cannot watch configuration: %r", error)
+            return
+        if mtime != self._config_mtime:
+            self._config_mtime = mtime
+            self.reload()
+
+    def _start_metrics(self):
+        interval = self.config.get("metrics")
+        if not interval:
+            return
+        from .metrics import Metrics
+
+        self.metrics = Metrics(self, interval)
+        self.metrics.start()
+
+    def _start_stats(self):
+        filename = self.config.get("stats")
+        if not filename:
+            return
+        from .shm import StatsWriter
+
+        self.stats_writer = StatsWriter(self, filename, self.config["stats_interval"])
+        self.stats_writer.start()
+
+    def _close_stats(self):
+        if self.stats_writer is not None:
+            self.stats_writer.close()
+            self.stats_writer = None
+
+    def _add_callback(self, fileobj, event, cb):
+        key = self.selector.get_map().get(fileobj)
+        if key is None:
+            self.selector.register(fileobj, event, {event: cb})
+        else:
+            key.data[event] = cb
+            if not key.events & event:
+                self.selector.modify(fileobj, key.events | event, key.data)
+
+    def _remove_callback(self, fileobj, event):
+        key = self.selector.get_map().get(fileobj)
+        if key is None or event not in key.data:
+            return False
+        # callbacks dict is shared with the selector key so that a pending
+        # event in the current step sees the removal
+        del key.data[event]
+        if key.data:
+            self.selector.modify(fileobj, key.events & ~event, key.data)
+        else:
+            self.selector.unregister(fileobj)
+        return True
+
     def add_reader(self, reader, cb):
-        self.selector.register(reader, selectors.EVENT_READ, cb)
+        self._add_callback(reader, selectors.EVENT_READ, cb)
 
     def remove_reader(self, reader):
-        if reader in self.selector.get_map():
-            self.selector.unregister(reader)
-            return True
-        return False
+        return self._remove_callback(reader, selectors.EVENT_READ)
+
+    def add_writer(self, writer, cb):
+        self._add_callback(writer, selectors.EVENT_WRITE, cb)
+
+    def remove_writer(self, writer):
+        return self._remove_callback(writer, selectors.EVENT_WRITE)
+
+    def call_later(self, delay, callback):
+        """schedule callback to be called after delay seconds"""
+        return self.call_at(monotonic() + delay, callback)
+
+    def call_at(self, when, callback):
+        """schedule callback to be called at when (monotonic() clock)"""
+        timer = Timer(when, callback, self)
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def call_every(self, interval, callback):
+        """schedule callback to be called every interval seconds"""
+        return PeriodicTimer(self, interval, callback)
+
+    def _timer_cancelled(self):
+        self._cancelled_timers += 1
+        timers = self._timers
+        if self._cancelled_timers > 64 and self._cancelled_timers > len(timers) // 2:
+            timers[:] = [timer for timer in timers if not timer.cancelled]
+            heapq.heapify(timers)
+            self._cancelled_timers = 0
+
+    def _pop_timer(self):
+        timer = heapq.heappop(self._timers)
+        if timer.cancelled:
+            self._cancelled_timers -= 1
+        timer.server = None
+        return timer
+
+    def _next_timeout(self):
+        timers = self._timers
+        while timers and timers[0].cancelled:
+            self._pop_timer()
+        if not timers:
+            return None
+        return max(0, timers[0].when - monotonic())
+
+    def _run_timers(self, profiler=None):
+        timers = self._timers
+        now = monotonic()
+        while timers and timers[0].when <= now:
+            timer = self._pop_timer()
+            if timer.cancelled:
+                continue
+            if profiler is None:
+                timer.callback()
+            else:
+                profiler.timer(now - timer.when)
+                profiler.run(timer.callback)
 
     def step(self):
-        events = self.selector.select()
+        events = self.selector.select(self._next_timeout())
+        if self._prioritized:
+            events.sort(key=_event_priority, reverse=True)
         for key, mask in events:
-            key.data()
+            callbacks = key.data
+            if mask & selectors.EVENT_READ:
+                cb = callbacks.get(selectors.EVENT_READ)
+                if cb is not None:
+                    cb()
+            if mask & selectors.EVENT_WRITE:
+                cb = callbacks.get(selectors.EVENT_WRITE)
+                if cb is not None:
+                    cb()
+        self._run_timers()
+
+    def _profiled_step(self):
+        # same as step but timing every callback (see enable_profiling)
+        profiler = self.profiler
+        events = self.selector.select(self._next_timeout())
+        start = monotonic()
+        if self._prioritized:
+            events.sort(key=_event_priority, reverse=True)
+        for key, mask in events:
+            callbacks = key.data
+            if mask & selectors.EVENT_READ:
+                cb = callbacks.get(selectors.EVENT_READ)
+                if cb is not None:
+                    profiler.run(cb)
+            if mask & selectors.EVENT_WRITE:
+                cb = callbacks.get(selectors.EVENT_WRITE)
+                if cb is not None:
+                    profiler.run(cb)
+        self._run_timers(profiler)
+        profiler.iteration(monotonic() - start)
+
+    def enable_profiling(self, slow_callback=0.1):
+        """
+        Time every callback run by the event loop and log the ones slower
+        than slow_callback seconds (see loop_stats). When disabled (the
+        default) the loop runs the plain step and pays nothing
+        """
+        self.profiler = LoopProfiler(slow_callback)
+        self.step = self._profiled_step
+
+    def disable_profiling(self):
+        self.profiler = None
+        self.__dict__.pop("step", None)
+
+    def loop_stats(self):
+        """event loop statistics (see LoopProfiler) or None if not profiling"""
+        return self.profiler.stats() if self.profiler is not None else None
 
     def run(self):
         while self.run_flag:
@@ -88,38 +482,219 @@ class Server:
         if self._csock:
             self._csock.sendall(self.shutdown_message)
 
+    def call_soon_threadsafe(self, callback):
+        """schedule callback in the event loop thread (safe from any thread)"""
+        with self._calls_lock:
+            self._calls.append(callback)
+        try:
+            self._csock.send(self.call_message)
+        except (socket.error, AttributeError):
+            # channel full (a wake up is already pending) or closed
+            pass
+
+    def run_in_loop(self, function, timeout=5):
+        """
+        Call function in the event loop thread and return its result. Meant
+        to be used from other threads (ex: the web UI)
+        """
+        done = threading.Event()
+        result = {}
+
+        def call():
+            try:
+                result["value"] = function()
+            except Exception as error:
+                result["error"] = error
+            finally:
+                done.set()
+
+        self.call_soon_threadsafe(call)
+        if not done.wait(timeout):
+            raise TimeoutError("event loop did not answer in time")
+        if "error" in result:
+            raise result["error"]
+        return result["value"]
+
+    def snapshot(self):
+        """state of the bridges (see BridgeStatus). Call from the event loop"""
+        return [BridgeStatus(bridge.config, bridge.status()) for bridge in self.bridges]
+
+    def request_reload(self):
+        """reload the configuration file (safe from signal handlers and threads)"""
+        if self._csock:
+            self._csock.sendall(self.reload_message)
+
+    def reload(self):
+        filename = self.config.get("filename")
+        if not filename:
+            logging.warning("reload: configuration was not loaded from a file")
+            return
+        logging.info("reloading %r", filename)
+        try:
+            config = load_config(filename)
+        except Exception as error:
+            logging.error("reload: invalid configuration %r: keep current one", error)
+            return
+        self.reconfig(config)
+
     def reconfig(self, config):
-        for bridge, config in zip(self.bridges, config["bridges"]):
-            bridge.reconfig(config)
+        """
+        Apply a new list of bridges. Bridges are matched by id (see
+        config.bridge_id): new ones are created, missing ones closed and the
+        others reconfigured (which leaves untouched bridges alone)
+        """
+        current = dict((bridge_id(bridge.config), bridge) for bridge in self.bridges)
+        ids = set(bridge_id(cfg) for cfg in config["bridges"])
+        # close first so that a new bridge may reuse a tcp address
+        for bid, bridge in list(current.items()):
+            if bid not in ids:
+                logging.info("removing bridge %r", bid)
+                bridge.close()
+                del current[bid]
+        bridges = []
+        for cfg in config["bridges"]:
+            bid = bridge_id(cfg)
+            bridge = current.get(bid)
+            if bridge is None:
+                logging.info("adding bridge %r", bid)
+                try:
+                    bridge = Bridge(cfg, self)
+                except Exception as error:
+                    logging.error("cannot create bridge %r: %r", bid, error)
+                    continue
+            else:
+                try:
+                    bridge.reconfig(cfg)
+                except Exception as error:
+                    # keep the sessions of this bridge (and of the others)
+                    msg = "cannot reconfigure bridge %r: %r (keeping it as it was)"
+                    logging.error(msg, bid, error)
+            bridges.append(bridge)
+        self.bridges = bridges
+        self.config = dict(self.config, bridges=[bridge.config for bridge in bridges])
+        self._update_priorities()
 
 
 SERVER = None
 
 
+def get_engine(name):
+    if name == "asyncio":
+        from .aio import AsyncServer
+
+        return AsyncServer
+    return Server
+
+
+def get_server_class(config):
+    if config["workers"] > 1:
+        from .workers import Supervisor
+
+        return Supervisor
+    return get_engine(config["engine"])
+
+
+def start_web(server, config):
+    """
+    Serve the web UI in its own thread so that it never stalls the bridges
+    (which also start accepting before the web UI is initialized)
+    """
+
+    def serve():
+        from .web import run
+
+        run(server, config)
+
+    thread = threading.Thread(target=serve, name="ser2sock-web")
+    thread.daemon = True
+    thread.start()
+
+
+def stop_web(server):
+    web_server = getattr(server, "web_server", None)
+    if web_server is not None:
+        web_server.stop()
+
+
+def reload_on_sighup(server):
+    import signal
+
+    if not hasattr(signal, "SIGHUP"):
+        return
+    try:
+        signal.signal(signal.SIGHUP, lambda signum, frame: server.request_reload())
+    except ValueError:
+        # signal handlers can only be installed from the main thread
+        logging.info("not in main thread: SIGHUP reload disabled")
+
+
 def run(options):
     global SERVER
     config = load_config(options.config)
+    if options.engine:
+        config["engine"] = options.engine
+    if options.workers:
+        config["workers"] = options.workers
     try:
-        with Server(config) as server:
+        with get_server_class(config)(config) as server:
             SERVER = server
+            reload_on_sighup(server)
             if config["web"]:
-                from .web import run
-
-                run(server, config)
-            else:
+                start_web(server, config)
+            try:
                 server.run()
+            finally:
+                stop_web(server)
     except KeyboardInterrupt:  # pragma: no cover
         logging.info("Interrupted. Bailing out...")
     finally:
         SERVER = None
 
 
+def check_config(options):
+    """print a summary of the configuration. Returns the exit code"""
+    try:
+        config = load_config(options.config)
+    except Exception as error:
+        print("{0}: invalid configuration: {1}".format(options.config, error))
+        return 1
+    for bridge in config["bridges"]:
+        print(
+            "{0}: {1} <-> {2}".format(
+                bridge_id(bridge), bridge["serial"]["port"], bridge["tcp"]["address"]
+            )
+        )
+    print("{0}: OK ({1} bridges)".format(options.config, len(config["bridges"])))
+    return 0
+
+
 def main(args=None):
+    import optparse
+
     parser = optparse.OptionParser()
     parser.add_option("-c", "--config", help="config file name")
+    parser.add_option(
+        "--engine",
+        choices=ENGINES,
+        help="event loop engine (overrides config). One of: " + ", ".join(ENGINES),
+    )
+    parser.add_option(
+        "--workers",
+        type="int",
+        help="number of worker processes among which bridges are distributed "
+        "(overrides config)",
+    )
+    parser.add_option(
+        "--check-config",
+        action="store_true",
+        default=False,
+        help="validate the configuration and exit (no port is opened)",
+    )
     options, args = parser.parse_args(args)
     if options.config is None:
         parser.error("Missing configuration file argument (-c/--config)")
+    if options.check_config:
+        sys.exit(check_config(options))
     run(options)
 
 
@@ -0,0 +1,240 @@
+import os
+import sys
+import time
+import mmap
+import struct
+import logging
+
+from .config import bridge_id
+
+# file layout: a header (magic, layout version, number of slots, server pid)
+# followed by one slot per bridge. Each slot starts with its own sequence
+# number (seqlock, see StatsWriter._write and read_stats)
+MAGIC = b"S2SK"
+VERSION = 1
+
+HEADER = struct.Struct("<4sIII")
+SEQ = struct.Struct("<Q")
+# id, port, serial state, clients, client_nb, client_bytes, serial_bytes,
+# client_dropped, client_buffered, serial_buffered, serial_losses,
+# reconnect_attempts, last connection (epoch, 0 if none), update time
+SLOT = struct.Struct("<64s64sBxxxIQQQQQQIIdd")
+SLOT_SIZE = SEQ.size + SLOT.size
+
+STATES = (None, "closed", "open", "reconnecting")
+
+# os.replace does not exist on python 2 (rename also replaces on POSIX)
+replace = getattr(os, "replace", os.rename)
+
+FIELDS = (
+    "id",
+    "port",
+    "serial_state",
+    "clients",
+    "client_nb",
+    "client_bytes",
+    "serial_bytes",
+    "client_dropped",
+    "client_buffered",
+    "serial_buffered",
+    "serial_losses",
+    "reconnect_attempts",
+    "client_ts",
+    "updated",
+)
+
+
+def _text(value):
+    return str(value).encode("utf-8")[:64]
+
+
+def _timestamp(value):
+    return time.mktime(value.timetuple()) + value.microsecond / 1e6 if value else 0.0
+
+
+class StatsWriter:
+    """
+    Publishes the bridges of a server (see Server.snapshot) every interval
+    seconds from the event loop. The file is recreated (atomically) when
+    the number of bridges outgrows it and removed when the server closes
+    """
+
+    def __init__(self, server, filename, interval):
+        self.server = server
+        self.filename = filename
+        self.interval = interval
+        self.slots = 0
+        # number of slots holding a bridge
+        self.used = 0
+        self.seqs = []
+        self.mmap = None
+        self.timer = None
+
+    def start(self):
+        self.publish()
+        self.timer = self.server.call_every(self.interval, self.publish)
+
+    def _create(self, slots):
+        self._unmap()
+        tmp = "{0}.{1}.tmp".format(self.filename, os.getpid())
+        with open(tmp, "wb") as fobj:
+            fobj.write(HEADER.pack(MAGIC, VERSION, slots, os.getpid()))
+            fobj.write(b"\0" * SLOT_SIZE * slots)
+        replace(tmp, self.filename)
+        with open(self.filename, "r+b") as fobj:
+            self.mmap = mmap.mmap(fobj.fileno(), 0)
+        self.slots = slots
+        self.used = 0
+        self.seqs = [0] * slots
+
+    def _unmap(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+    def publish(self):
+        try:
+            self._publish(self.server.snapshot())
+        except Exception:
+            logging.exception("error publishing statistics to %r", self.filename)
+
+    def _publish(self, bridges):
+        if self.mmap is None or len(bridges) > self.slots:
+            self._create(max(16, 2 * len(bridges)))
+        now = time.time()
+        for index, bridge in enumerate(bridges):
+            self._write(index, self._pack(bridge, now))
+        # slots left by removed bridges
+        for index in range(len(bridges), self.used):
+            self._write(index, b"\0" * SLOT.size)
+        self.used = len(bridges)
+
+    def _pack(self, bridge, now):
+        state = bridge.serial_state
+        return SLOT.pack(
+            _text(bridge_id(bridge.config)),
+            _text(bridge.config["serial"]["port"]),
+            STATES.index(state) if state in STATES else 0,
+            len(bridge.client_addrs or ()),
+            bridge.client_nb or 0,
+            bridge.client_bytes or 0,
+            bridge.serial_bytes or 0,
+            bridge.client_dropped or 0,
+            bridge.client_buffered or 0,
+            bridge.serial_buffered or 0,
+            bridge.serial_losses or 0,
+            bridge.reconnect_attempts or 0,
+            _timestamp(bridge.client_ts),
+            now,
+        )
+
+    def _write(self, index, data):
+        # the sequence number is odd while the slot is being updated
+        offset = HEADER.size + index * SLOT_SIZE
+        seq = self.seqs[index]
+        SEQ.pack_into(self.mmap, offset, seq + 1)
+        self.mmap[offset + SEQ.size : offset + SLOT_SIZE] = data
+        SEQ.pack_into(self.mmap, offset, seq + 2)
+        self.seqs[index] = seq + 2
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self._unmap()
+        try:
+            os.unlink(self.filename)
+        except OSError:
+            pass
+
+
+def _read_slot(buff, index, retries=1000):
+    offset = HEADER.size + index * SLOT_SIZE
+    for _ in range(retries):
+        (seq,) = SEQ.unpack_from(buff, offset)
+        if seq & 1:
+            continue
+        values = SLOT.unpack_from(buff, offset + SEQ.size)
+        if SEQ.unpack_from(buff, offset)[0] == seq:
+            return values
+    raise RuntimeError("slot {0} keeps changing".format(index))
+
+
+def read_stats(filename):
+    """
+    Read the statistics published by a server. Lock free: a slot is read
+    again if its sequence number is odd (update in progress) or changed
+    while it was read. Returns the server pid and a list of dicts (see
+    FIELDS)
+    """
+    with open(filename, "rb") as fobj:
+        buff = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        magic, version, slots, pid = HEADER.unpack_from(buff, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{0} is not a ser2sock statistics file".format(filename))
+        bridges = []
+        for index in range(slots):
+            values = _read_slot(buff, index)
+            if not values[0].strip(b"\0"):
+                continue
+            bridge = dict(zip(FIELDS, values))
+            bridge["id"] = bridge["id"].rstrip(b"\0").decode("utf-8", "replace")
+            bridge["port"] = bridge["port"].rstrip(b"\0").decode("utf-8", "replace")
+            bridge["serial_state"] = STATES[bridge["serial_state"]]
+            bridges.append(bridge)
+        return pid, bridges
+    finally:
+        buff.close()
+
+
+def _print_table(pid, bridges):
+    print("pid {0}".format(pid))
+    columns = (
+        "id",
+        "serial_state",
+        "clients",
+        "client_nb",
+        "client_bytes",
+        "serial_bytes",
+        "serial_losses",
+    )
+    line = " ".join("{{{0}:>14.14}}".format(index) for index in range(len(columns)))
+    print(line.format(*columns))
+    for bridge in bridges:
+        print(line.format(*(str(bridge[column]) for column in columns)))
+
+
+def main(args=None):
+    import optparse
+
+    parser = optparse.OptionParser(
+        usage="%prog [options] <statistics file>",
+        description="show the bridge statistics published by a ser2sock server",
+    )
+    parser.add_option("--json", action="store_true", default=False, help="JSON output")
+    parser.add_option(
+        "--watch", type="float", default=0, help="refresh every WATCH seconds"
+    )
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("Missing statistics file argument")
+    while True:
+        try:
+            pid, bridges = read_stats(args[0])
+        except (OSError, ValueError, RuntimeError) as error:
+            print("{0}: {1}".format(args[0], error))
+            sys.exit(1)
+        if options.json:
+            import json
+
+            print(json.dumps(dict(pid=pid, bridges=bridges)))
+        else:
+            _print_table(pid, bridges)
+        if not options.watch:
+            break
+        time.sleep(options.watch)
+
+
+if __name__ == "__main__":
+    main()  # pragma: no cover
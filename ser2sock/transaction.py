@@ -0,0 +1,169 @@
+import logging
+import collections
+
+from .cache import ReplyCache
+from .comm import monotonic
+from .framing import create_framer
+
+
+class Arbiter:
+    """
+    Serializes requests coming from several clients onto the serial line
+    (one at a time) and routes each reply back to the client which sent
+    the request.
+
+    Requests are delimited by the tcp request_terminator. The end of a
+    reply is detected by reply_terminator or reply_size and, failing
+    that, by an idle gap of reply_gap seconds on the serial line. A
+    request which gets no reply within reply_timeout seconds is
+    considered done.
+
+    Requests matching the tcp cache option are answered from a ReplyCache
+    when possible, without going through the serial line.
+    """
+
+    def __init__(self, bridge):
+        self.bridge = bridge
+        # complete requests waiting for the serial line:
+        # (client, request, looked up in cache)
+        self.requests = collections.deque()
+        # partial request of each client
+        self.framers = {}
+        # True while waiting for a reply
+        self.pending = False
+        # client waiting for the reply (None if it left in the meantime)
+        self.client = None
+        self.request = None
+        self.reply = None
+        # when the pending request was written (monotonic clock)
+        self.started = None
+        self.timer = None
+        self.transactions = 0
+        self.timeouts = 0
+        self.cache = None
+        self.make_cache()
+
+    @property
+    def options(self):
+        return self.bridge.config["tcp"]
+
+    def make_cache(self):
+        """(re)create the reply cache from the current options"""
+        opts = self.options
+        if opts["cache"]:
+            self.cache = ReplyCache(
+                opts["cache"], opts["cache_ttl"], opts["cache_size"]
+            )
+        else:
+            self.cache = None
+
+    def on_request_data(self, client, data):
+        framer = self.framers.get(client)
+        if framer is None:
+            framer = create_framer(terminator=self.options["request_terminator"])
+            self.framers[client] = framer
+        for request in framer.feed(data):
+            # replies must be sent in order: only use the cache right away
+            # if the client has no outstanding request
+            looked_up = False
+            if self.cache is not None and not self.outstanding(client):
+                if self.from_cache(client, request):
+                    continue
+                looked_up = True
+            self.requests.append((client, request, looked_up))
+        self.next()
+
+    def outstanding(self, client):
+        return self.client is client or any(item[0] is client for item in self.requests)
+
+    def from_cache(self, client, request):
+        """answer request from the cache. Returns True on success"""
+        if not self.cache.cacheable(request):
+            return False
+        reply = self.cache.get(request)
+        if reply is None:
+            return False
+        self.bridge.write_client(client, reply)
+        return True
+
+    def next(self):
+        while self.requests and not self.pending:
+            client, request, looked_up = self.requests.popleft()
+            if self.cache is not None and not looked_up:
+                if self.from_cache(client, request):
+                    continue
+            self.start(client, request)
+
+    def start(self, client, request):
+        self.pending = True
+        self.client = client
+        self.request = request
+        self.started = monotonic()
+        opts = self.options
+        self.reply = create_framer(
+            terminator=opts["reply_terminator"], size=opts["reply_size"]
+        )
+        self._arm(opts["reply_timeout"])
+        self.bridge.write_serial(request)
+
+    def _arm(self, delay):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.bridge.server.call_later(delay, self.on_timeout)
+
+    def on_reply_data(self, data):
+        if not self.pending:
+            logging.info("%d bytes of unsolicited serial data discarded", len(data))
+            return
+        frames = self.reply.feed(data)
+        if frames:
+            self.done(frames[0])
+        elif self.options["reply_gap"]:
+            self._arm(self.options["reply_gap"])
+
+    def on_timeout(self):
+        self.timer = None
+        reply = self.reply.flush()
+        if not reply:
+            self.timeouts += 1
+            logging.warning("no reply from %r", self.bridge.config["serial"]["port"])
+        self.done(reply)
+
+    def done(self, reply):
+        client = self.client
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        # a new reply framer is made for the next request (see start)
+        extra = len(self.reply)
+        if extra:
+            logging.info("%d bytes after reply discarded", extra)
+        self.pending = False
+        self.client = None
+        self.transactions += 1
+        self.bridge.histograms["transaction"].observe(monotonic() - self.started)
+        if reply and self.cache is not None and self.cache.cacheable(self.request):
+            self.cache.put(self.request, reply)
+        self.request = None
+        if reply and client is not None:
+            self.bridge.write_client(client, reply)
+        self.next()
+
+    def forget(self, client):
+        """client left: drop its requests and its pending reply"""
+        self.framers.pop(client, None)
+        self.requests = collections.deque(
+            item for item in self.requests if item[0] is not client
+        )
+        if self.client is client:
+            self.client = None
+
+    def reset(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.requests.clear()
+        self.framers.clear()
+        self.pending = False
+        self.client = None
+        self.request = None
@@ -1,14 +1,30 @@
 import os
+import json
 import socket
 
+try:
+    import socketserver
+except ImportError:  # python 2
+    import SocketServer as socketserver
+
 import serial
 import bottle
 import wsgiref.simple_server
 
-from .config import tcp_host_port, human_size
+from .config import tcp_host_port, human_size, to_bridge, bridge_id
+
+
+class ThreadingWSGIServer(
+    socketserver.ThreadingMixIn, wsgiref.simple_server.WSGIServer
+):
+    daemon_threads = True
 
 
 def run(server, config):
+    """
+    Serve the web UI (blocking: meant to run in its own thread). Bridges
+    are only read and changed from the server event loop thread
+    """
     this_dir = os.path.dirname(__file__)
 
     bottle.TEMPLATE_PATH += [this_dir]
@@ -24,6 +40,8 @@ def run(server, config):
             index = int(index)
             if name in ("baudrate", "bytesize"):
                 value = int(value)
+            if name == "capture":
+                value = value == "on"
             if name == "stopbits":
                 try:
                     value = int(value)
@@ -32,14 +50,27 @@ def run(server, config):
                     value = float(value)
             bridge = bridges.setdefault(index, {})
             bridge.setdefault(domain, {})[name] = value
-        bridges = [to_bridge(bridges[index]) for index in sorted(bridges)]
-        return dict(bridges=bridges)
+        # options (and bridges) not present in the form keep their current
+        # value. Bridges keep their identity even if their port changes.
+        # Runs in the event loop thread (see apply)
+        result = []
+        for index, current in enumerate(server.config["bridges"]):
+            config = current
+            if index in bridges:
+                config = dict(
+                    (domain, dict(config[domain], **bridges[index].get(domain, {})))
+                    for domain in ("serial", "tcp")
+                )
+                config = to_bridge(dict(config, name=bridge_id(current)))
+            result.append(config)
+        return dict(bridges=result)
 
     @app.get("/")
     def index():
         return bottle.template(
             "index.tpl",
-            server=server,
+            bridges=server.run_in_loop(server.snapshot),
+            loop=server.run_in_loop(server.loop_stats),
             hostname=socket.gethostname(),
             baudrates=serial.Serial.BAUDRATES,
             human_size=human_size,
@@ -47,10 +78,33 @@ def run(server, config):
 
     @app.post("/")
     def apply():
-        new_config = form_to_config(bottle.request.forms)
-        server.reconfig(new_config)
+        form = dict(bottle.request.forms.items())
+        server.run_in_loop(lambda: server.reconfig(form_to_config(form)))
         return bottle.redirect("/")
 
+    def metrics():
+        if server.metrics is None:
+            bottle.abort(404, "metrics are disabled")
+        return server.metrics
+
+    @app.get("/metrics")
+    def prometheus():
+        bottle.response.content_type = "text/plain; version=0.0.4; charset=utf-8"
+        return metrics().text
+
+    @app.get("/api/status")
+    def api_status():
+        bottle.response.content_type = "application/json"
+        return metrics().json
+
+    @app.get("/api/loop")
+    def api_loop():
+        stats = server.run_in_loop(server.loop_stats)
+        if stats is None:
+            bottle.abort(404, "event loop profiling is disabled")
+        bottle.response.content_type = "application/json"
+        return json.dumps(stats)
+
     @app.route("/static/<filename>")
     def static(filename):
         return bottle.static_file(filename, root=this_dir)
@@ -58,12 +112,15 @@ def run(server, config):
     class WebServer(bottle.ServerAdapter):
         def run(self, app):  # pragma: no cover
             self.web_server = wsgiref.simple_server.make_server(
-                self.host, self.port, app
+                self.host, self.port, app, server_class=ThreadingWSGIServer
             )
-            sock = self.web_server.socket
-            sock.setblocking(False)
-            server.add_reader(sock, self.web_server.handle_request)
-            server.run()
+            self.web_server.serve_forever()
+
+        def stop(self):
+            web_server = getattr(self, "web_server", None)
+            if web_server is not None:
+                web_server.shutdown()
+                web_server.server_close()
 
     web_server = WebServer(host, port)
     server.web_server = web_server
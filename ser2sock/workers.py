@@ -0,0 +1,269 @@
+import signal
+import logging
+import threading
+import functools
+import multiprocessing
+
+from .bridge import BridgeStatus
+from .comm import monotonic, TimeoutError
+from .config import bridge_id
+from .server import Server, get_engine
+
+
+# a crashed worker is restarted at once, then after a delay doubling on
+# every crash up to RESTART_MAX_DELAY. Running for RESTART_RESET seconds
+# makes it healthy again
+RESTART_DELAY = 0.5
+RESTART_MAX_DELAY = 30.0
+RESTART_RESET = 60.0
+
+
+def shard(config, workers):
+    """distribute bridge ids among workers (round robin)"""
+    ids = [bridge_id(bridge) for bridge in config["bridges"]]
+    return [ids[i::workers] for i in range(workers)]
+
+
+def sub_config(config, ids):
+    bridges = [bridge for bridge in config["bridges"] if bridge_id(bridge) in ids]
+    # the supervisor takes care of watching the configuration file, of the
+    # metrics and of the statistics file
+    return dict(config, bridges=bridges, watch=0, metrics=0, stats=None)
+
+
+def worker_main(config, conn):
+    if hasattr(signal, "SIGHUP"):
+        # reloading is driven by the supervisor
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    with get_engine(config["engine"])(config) as server:
+
+        def on_command():
+            try:
+                command = conn.recv()
+            except EOFError:
+                logging.error("lost connection to supervisor. Bailing out...")
+                server.remove_reader(conn)
+                server.stop()
+                return
+            name, args = command[0], command[1:]
+            # requests end with a sequence number sent back with the reply
+            # (see Worker.request)
+            if name == "status":
+                statuses = [
+                    (bridge_id(bridge.config), bridge.status())
+                    for bridge in server.bridges
+                ]
+                conn.send((args[-1], statuses))
+            elif name == "loop_stats":
+                conn.send((args[-1], server.loop_stats()))
+            elif name == "reconfig":
+                try:
+                    server.reconfig(*args)
+                except Exception as error:
+                    logging.error("worker reconfig failed: %r", error)
+            elif name == "stop":
+                server.stop()
+
+        server.add_reader(conn, on_command)
+        try:
+            server.run()
+        except KeyboardInterrupt:
+            pass
+
+
+def merge_loop_stats(stats):
+    """combine the event loop statistics of several processes"""
+    stats = [item for item in stats if item is not None]
+    if not stats:
+        return None
+    result = dict(
+        slow_callback=stats[0]["slow_callback"],
+        iterations=sum(item["iterations"] for item in stats),
+        lag_total=sum(item["lag_total"] for item in stats),
+        lag_max=max(item["lag_max"] for item in stats),
+        timer_lag_max=max(item["timer_lag_max"] for item in stats),
+        slow=sum(item["slow"] for item in stats),
+        callbacks={},
+        bridges={},
+    )
+    for item in stats:
+        for table in ("callbacks", "bridges"):
+            for key, value in item[table].items():
+                total = result[table].setdefault(key, dict(count=0, total=0.0, max=0.0))
+                total["count"] += value["count"]
+                total["total"] += value["total"]
+                total["max"] = max(total["max"], value["max"])
+    return result
+
+
+class Worker:
+    def __init__(self, index, ids):
+        self.index = index
+        # ids of the bridges (see config.bridge_id) handled by this worker
+        self.ids = ids
+        self.process = None
+        self.conn = None
+        self.restarts = 0
+        # crashes since the worker was last healthy (see RESTART_RESET)
+        self.crashes = 0
+        self.started = None
+        # pending restart (see Supervisor._on_worker_exit)
+        self.restart_timer = None
+        # sequence number of the last request (see request)
+        self.seq = 0
+
+    def start(self, config):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=worker_main,
+            args=(sub_config(config, self.ids), child_conn),
+            name="ser2sock-worker-{0}".format(self.index),
+        )
+        self.process.daemon = True
+        self.process.start()
+        self.started = monotonic()
+        child_conn.close()
+        logging.info("started worker %d (pid=%d)", self.index, self.process.pid)
+
+    def stop(self, timeout=2):
+        try:
+            self.conn.send(("stop",))
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
+
+    def request(self, command, timeout=1):
+        """
+        Send a command and wait for its reply. Late replies to requests
+        which timed out are discarded
+        """
+        self.seq += 1
+        self.conn.send(command + (self.seq,))
+        deadline = monotonic() + timeout
+        while self.conn.poll(max(0, deadline - monotonic())):
+            seq, reply = self.conn.recv()
+            if seq == self.seq:
+                return reply
+            logging.info("worker %d: discarded late reply #%d", self.index, seq)
+        raise TimeoutError("worker {0} did not reply".format(self.index))
+
+
+class Supervisor(Server):
+    """
+    Server which distributes the bridges among several worker processes
+    and restarts them if they crash. Reconfiguration requests and bridge
+    statistics are routed to/from the worker owning each bridge.
+    """
+
+    def __init__(self, config):
+        Server.__init__(self, config)
+        self.workers = [
+            Worker(index, ids)
+            for index, ids in enumerate(shard(config, config["workers"]))
+        ]
+        self._lock = threading.Lock()
+
+    def _make_bridges(self):
+        for worker in self.workers:
+            self._start_worker(worker)
+
+    def _start_worker(self, worker):
+        # the status and reconfig requests of other threads use worker.conn
+        with self._lock:
+            if worker.conn is not None:
+                worker.conn.close()
+            worker.start(self.config)
+        cb = functools.partial(self._on_worker_exit, worker)
+        self.add_reader(worker.process.sentinel, cb)
+
+    def _on_worker_exit(self, worker):
+        if worker.process is None:
+            return
+        self.remove_reader(worker.process.sentinel)
+        worker.process.join()
+        if not self.run_flag:
+            return
+        if monotonic() - worker.started > RESTART_RESET:
+            worker.crashes = 0
+        delay = 0
+        if worker.crashes:
+            delay = min(RESTART_DELAY * 2 ** (worker.crashes - 1), RESTART_MAX_DELAY)
+        worker.crashes += 1
+        logging.error(
+            "worker %d died (exit code %r). Restarting it in %.1fs...",
+            worker.index,
+            worker.process.exitcode,
+            delay,
+        )
+        cb = functools.partial(self._restart_worker, worker)
+        worker.restart_timer = self.call_later(delay, cb)
+
+    def _restart_worker(self, worker):
+        worker.restart_timer = None
+        self._start_worker(worker)
+        worker.restarts += 1
+
+    def collect_status(self):
+        """
+        State of the bridges (see BridgeStatus) gathered from the workers.
+        Blocks until every worker answered (or timed out)
+        """
+        bridges = [BridgeStatus(config) for config in self.config["bridges"]]
+        by_id = dict((bridge_id(bridge.config), bridge) for bridge in bridges)
+        with self._lock:
+            for worker in self.workers:
+                try:
+                    statuses = worker.request(("status",))
+                except (OSError, EOFError) as error:
+                    logging.warning("worker %d status: %r", worker.index, error)
+                    continue
+                for bid, status in statuses:
+                    if bid in by_id:
+                        by_id[bid].__dict__.update(status)
+        return bridges
+
+    def snapshot(self):
+        return self.collect_status()
+
+    def loop_stats(self):
+        stats = [Server.loop_stats(self)]
+        with self._lock:
+            for worker in self.workers:
+                try:
+                    stats.append(worker.request(("loop_stats",)))
+                except (OSError, EOFError) as error:
+                    logging.warning("worker %d loop stats: %r", worker.index, error)
+        return merge_loop_stats(stats)
+
+    def close(self):
+        self._close_stats()
+        self.run_flag = False
+        for worker in self.workers:
+            if worker.restart_timer is not None:
+                worker.restart_timer.cancel()
+                worker.restart_timer = None
+            if worker.process is not None:
+                self.remove_reader(worker.process.sentinel)
+                worker.stop()
+                worker.process = None
+        self._close_self_channel()
+        self.selector.close()
+
+    def reconfig(self, config):
+        # bridges stay in their worker, new ones go to the least loaded worker
+        ids = [bridge_id(bridge) for bridge in config["bridges"]]
+        with self._lock:
+            for worker in self.workers:
+                worker.ids = [bid for bid in worker.ids if bid in ids]
+            assigned = set(bid for worker in self.workers for bid in worker.ids)
+            for bid in ids:
+                if bid not in assigned:
+                    worker = min(self.workers, key=lambda worker: len(worker.ids))
+                    worker.ids.append(bid)
+            self.config = dict(self.config, bridges=list(config["bridges"]))
+            for worker in self.workers:
+                worker.conn.send(("reconfig", sub_config(self.config, worker.ids)))
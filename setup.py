@@ -51,7 +51,8 @@ setup(
     install_requires=requires,
     extras_require={
         ':python_version < "3"': ['selectors2'],
-        'web': ['bottle']  # < 0.13 if python 2.6
+        'web': ['bottle'],  # < 0.13 if python 2.6
+        'toml': ['tomli; python_version < "3.11"'],
     },
     setup_requires=setup_requirements,
     test_suite="tests",
@@ -63,6 +64,8 @@ setup(
     entry_points={
         'console_scripts': [
             'ser2sock = ser2sock.server:main',
+            'ser2sock-stats = ser2sock.shm:main',
+            'ser2sock-capture = ser2sock.capture:main',
         ],
     },
     url="https://github.com/tiagocoutinho/ser2sock/",
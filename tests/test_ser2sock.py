@@ -1,13 +1,24 @@
 import io
 import os
+import json
+import sys
 import time
 import errno
 import socket
 import threading
+import collections
+import subprocess
+import urllib.parse
 import urllib.request
 
 import ser2sock.server
+import ser2sock.comm
+import ser2sock.bridge
 import ser2sock.config
+import ser2sock.framing
+import ser2sock.metrics
+import ser2sock.shm
+import ser2sock.capture
 
 import pytest
 
@@ -27,6 +38,8 @@ web = ":0"
 """
 
 
+
+
 REQUEST = b"*IDN?\n"
 REPLY = b"ACME,road-runner,v1.245,58477272"
 
@@ -105,6 +118,42 @@ def web_server(tmp_path):
         yield i
 
 
+@pytest.fixture
+def metrics_server(tmp_path):
+    for i in _server(WEB_CONFIG_TEMPLATE + "metrics = 0.1\n", tmp_path):
+        yield i
+
+
+@pytest.fixture
+def profiled_server(tmp_path):
+    for i in _server(CONFIG_TEMPLATE + "slow_callback = 0.5\n", tmp_path):
+        yield i
+
+
+@pytest.fixture
+def async_server(tmp_path):
+    template = CONFIG_TEMPLATE + 'engine = "asyncio"\n'
+    for i in _server(template, tmp_path):
+        yield i
+
+
+def _options(options):
+    text = "".join(", {0}={1!r}".format(*item) for item in sorted(options.items()))
+    return text.replace("{", "{{").replace("}", "}}")
+
+
+@pytest.fixture
+def bridge_server(request, tmp_path):
+    # indirect parameter: extra options of the bridge, ex:
+    # dict(serial=dict(reconnect=True), tcp=dict(max_clients=2))
+    serial = _options(request.param.get("serial", {}))
+    tcp = _options(request.param.get("tcp", {}))
+    template = CONFIG_TEMPLATE.replace('port="{serial}"', 'port="{serial}"' + serial)
+    template = template.replace('address=":0"', 'address=":0"' + tcp)
+    for i in _server(template, tmp_path):
+        yield i
+
+
 @pytest.fixture
 def server_no_hw(tmp_path):
     assert ser2sock.server.SERVER is None
@@ -136,6 +185,8 @@ def test_load_config():
 
 
 def test_web_server(web_server):
+    while not hasattr(getattr(web_server, "web_server", None), "web_server"):
+        time.sleep(0.01)
     _, port = web_server.bridges[0].sock.getsockname()
     with socket.create_connection(('localhost', port)) as client:
         client.sendall(REQUEST)
@@ -215,3 +266,1237 @@ def test_2_clients_to_1_serial(server):
         assert client3.recv(1024) == REPLY
 
 
+def test_serial_write_does_not_block(server):
+    bridge = server.bridges[0]
+    _, port = bridge.sock.getsockname()
+    high_water = bridge.config["serial"]["high_water"]
+    payload = bytes(bytearray(range(256))) * (4 * high_water // 256)
+    with socket.create_connection(('localhost', port)) as client:
+        client.settimeout(5)
+        sender = threading.Thread(target=client.sendall, args=(payload,))
+        sender.daemon = True
+        sender.start()
+        # nobody reads the serial line: data gets queued and the client paused
+        while not bridge.clients or not bridge.clients[0].paused:
+            time.sleep(0.01)
+        assert len(bridge.serial_buffer) >= high_water
+        # the event loop is still alive: a second client is rejected
+        with pytest.raises(ConnectionError):
+            with socket.create_connection(('localhost', port)) as client2:
+                client2.settimeout(5)
+                client2.sendall(REQUEST)
+                assert not client2.recv(1024)
+                raise ConnectionResetError()
+        data = bytearray()
+        while len(data) < len(payload):
+            data += os.read(server.hardware.master_fd, 65536)
+        sender.join()
+        assert data == payload
+        # the bridge may not have accounted for the last write yet
+        while bridge.serial_buffer or bridge.clients[0].paused:
+            time.sleep(0.01)
+
+
+def test_slow_client_does_not_block(server):
+    bridge = server.bridges[0]
+    _, port = bridge.sock.getsockname()
+    high_water = bridge.config["tcp"]["high_water"]
+    # big enough to fill the kernel socket buffers
+    payload = bytes(bytearray(range(256))) * 4096 * 16
+    with socket.create_connection(('localhost', port)) as client:
+        client.settimeout(5)
+        client.sendall(REQUEST)
+        server.hardware.handle_request()
+        assert client.recv(1024) == REPLY
+        # client does not read: data is buffered and the serial line paused
+        writer = threading.Thread(
+            target=os.write, args=(server.hardware.master_fd, payload)
+        )
+        writer.daemon = True
+        writer.start()
+        while not bridge.serial_paused:
+            time.sleep(0.01)
+        assert bridge.client_buffered >= high_water
+        assert len(bridge.clients) == 1
+        data = bytearray()
+        while len(data) < len(payload):
+            data += client.recv(65536)
+        writer.join()
+        assert data == payload
+        assert not bridge.client_buffered
+        assert not bridge.serial_paused
+
+
+@pytest.mark.parametrize(
+    "bridge_server",
+    [dict(serial=dict(buffer_size=8), tcp=dict(buffer_size=4))],
+    indirect=True,
+)
+def test_small_buffers(bridge_server):
+    bridge = bridge_server.bridges[0]
+    assert len(bridge.tcp_view) == 4
+    assert len(bridge.serial_view) == 8
+    _, port = bridge.sock.getsockname()
+    with socket.create_connection(('localhost', port)) as client:
+        client.sendall(REQUEST)
+        bridge_server.hardware.handle_request()
+        data = b""
+        while len(data) < len(REPLY):
+            data += client.recv(1024)
+        assert data == REPLY
+    assert bridge.client_bytes == len(REQUEST)
+    assert bridge.serial_bytes == len(REPLY)
+
+
+def test_native_serial_port(server):
+    bridge = server.bridges[0]
+    _, port = bridge.sock.getsockname()
+    with socket.create_connection(('localhost', port)) as client:
+        client.sendall(REQUEST)
+        server.hardware.handle_request()
+        assert client.recv(1024) == REPLY
+        # native serial lines are read directly from their file descriptor
+        assert bridge.serial_fd == bridge.serial.fileno()
+
+
+def test_url_serial_port(tmp_path):
+    with socket.socket() as device:
+        device.bind(('localhost', 0))
+        device.listen(1)
+        url = "socket://localhost:{}".format(device.getsockname()[1])
+        template = CONFIG_TEMPLATE.replace("{serial}", url)
+        for server in _server(template, tmp_path):
+            bridge = server.bridges[0]
+            _, port = bridge.sock.getsockname()
+            with socket.create_connection(('localhost', port)) as client:
+                client.sendall(REQUEST)
+                conn, _ = device.accept()
+                with conn:
+                    assert conn.recv(1024) == REQUEST
+                    conn.sendall(REPLY)
+                    data = b""
+                    while len(data) < len(REPLY):
+                        data += client.recv(1024)
+                    assert data == REPLY
+                # URL ports go through pyserial
+                assert bridge.serial_fd is None
+
+
+@pytest.mark.skipif(not hasattr(os, "splice"), reason="needs os.splice")
+@pytest.mark.parametrize(
+    "bridge_server", [dict(tcp=dict(zero_copy=True))], indirect=True
+)
+def test_zero_copy(bridge_server):
+    bridge = bridge_server.bridges[0]
+    _, port = bridge.sock.getsockname()
+    with socket.create_connection(('localhost', port)) as client:
+        client.sendall(REQUEST)
+        bridge_server.hardware.handle_request()
+        data = b""
+        while len(data) < len(REPLY):
+            data += client.recv(1024)
+        assert data == REPLY
+        assert bridge.clients[0].pipe is not None
+    assert bridge.client_bytes == len(REQUEST)
+    assert bridge.serial_bytes == len(REPLY)
+
+
+def test_async_server(async_server):
+    from ser2sock.aio import AsyncServer
+
+    assert isinstance(async_server, AsyncServer)
+    # shares the Server state but asyncio does the selecting
+    assert async_server.selector is None
+    assert async_server._prioritized is False
+    _, port = async_server.bridges[0].sock.getsockname()
+    with socket.create_connection(('localhost', port)) as client:
+        client.sendall(REQUEST)
+        async_server.hardware.handle_request()
+        data = b""
+        while len(data) < len(REPLY):
+            data += client.recv(1024)
+        assert data == REPLY
+
+
+JSON_CONFIG = """
+{
+  "bridges": [
+    {"serial": {"port": "/dev/ttyS0", "open_policy": "always_open"},
+     "tcp": {"address": ":0", "request_terminator": "\\r"}},
+    {"name": "second", "serial": {"port": "/dev/ttyS1", "baudrate": 19200},
+     "tcp": {"address": ["0", 18501]}}
+  ],
+  "workers": 2
+}
+"""
+
+TOML_CONFIG = """
+watch = 2
+
+[[bridges]]
+serial = {port = "/dev/ttyS0", open_policy = "always_open"}
+tcp = {address = ":0", request_terminator = "\\r"}
+
+[[bridges]]
+name = "second"
+serial = {port = "/dev/ttyS1", baudrate = 19200}
+tcp = {address = ["0", 18501]}
+"""
+
+
+@pytest.mark.parametrize(
+    "ext, text", [(".json", JSON_CONFIG), (".toml", TOML_CONFIG)], ids=["json", "toml"]
+)
+def test_declarative_config(ext, text, tmp_path, monkeypatch):
+    pytest.importorskip("tomllib" if ext == ".toml" else "json")
+    monkeypatch.setenv("SER2SOCK_CACHE_DIR", str(tmp_path / "cache"))
+    filename = tmp_path / ("config" + ext)
+    filename.write_text(text)
+    config = ser2sock.config.load_config(filename)
+    first, second = config["bridges"]
+    assert first["serial"] == dict(
+        ser2sock.config.SERIAL_DEFAULTS, port="/dev/ttyS0", open_policy="always_open"
+    )
+    assert first["tcp"]["request_terminator"] == b"\r"
+    assert second["name"] == "second"
+    assert second["tcp"]["address"] == "0:18501"
+    assert config["filename"] == str(filename)
+    # the validated TOML document is cached
+    cache = tmp_path / "cache"
+    cached = os.listdir(str(cache)) if cache.exists() else []
+    assert len(cached) == (1 if ext == ".toml" else 0)
+    assert ser2sock.config.load_config(filename) == config
+    if cached:
+        # a cache file writable by others is not trusted
+        os.chmod(str(cache / cached[0]), 0o666)
+        (cache / cached[0]).write_text('{"bridges": []}')
+        assert ser2sock.config.load_config(filename) == config
+
+
+def _document(serial=None, tcp=None, **config):
+    bridge = dict(
+        serial=dict(dict(port="/dev/ttyS0"), **(serial or {})),
+        tcp=dict(dict(address=":0"), **(tcp or {})),
+    )
+    return dict(dict(bridges=[bridge]), **config)
+
+
+@pytest.mark.parametrize(
+    "document",
+    [
+        _document(serial=dict(baudrat=9600)),
+        _document(tcp=dict(tos="low")),
+        dict(bridges=[dict(serial=dict(port="/dev/ttyS0"))]),
+        _document(tcp=dict(reply_size="8")),
+        _document(serial=dict(timeout="1")),
+        _document(serial=dict(read_budget=True)),
+        dict(bridges=[dict(_document()["bridges"][0], name=5)]),
+        _document(workers="2"),
+        _document(web=8000),
+        _document(stats=None),
+        dict(bridges={}),
+    ],
+    ids=[
+        "unknown",
+        "type",
+        "missing",
+        "optional",
+        "pyserial",
+        "bool",
+        "name",
+        "workers",
+        "web",
+        "stats",
+        "bridges",
+    ],
+)
+def test_declarative_config_validation(document, tmp_path, monkeypatch):
+    monkeypatch.setenv("SER2SOCK_CACHE_DIR", str(tmp_path / "cache"))
+    filename = tmp_path / "config.json"
+    filename.write_text(json.dumps(document))
+    with pytest.raises(ValueError):
+        ser2sock.config.load_config(filename)
+
+
+def test_parallel_bridges(tmp_path):
+    template = CONFIG_TEMPLATE.replace(
+        'serial(port="{serial}")', 'serial(port="{serial}", open_policy="always_open")'
+    ).replace("]\n]", "],\n    [serial(port='/dev/tty-void'), tcp(address=':0')]\n]")
+    for server in _server(template, tmp_path):
+        first, second = server.bridges
+        assert first.serial_state == "open"
+        assert second.serial_state == "closed"
+        _, port = first.sock.getsockname()
+        with socket.create_connection(('localhost', port)) as client:
+            client.sendall(REQUEST)
+            server.hardware.handle_request()
+            assert client.recv(1024) == REPLY
+
+
+def test_parallel_bridges_failure(monkeypatch):
+    prepared = []
+
+    def prepare_bridge(config):
+        prepared.append(ser2sock.bridge.prepare_bridge(config))
+        return prepared[-1]
+
+    monkeypatch.setattr(ser2sock.server, "prepare_bridge", prepare_bridge)
+    with socket.socket() as blocker:
+        blocker.bind(("", 0))
+        blocker.listen(1)
+        config = ser2sock.config.sanitize_config(
+            dict(
+                bridges=[
+                    dict(
+                        name=str(index),
+                        serial=dict(port="/dev/tty-void"),
+                        tcp=dict(address=addr),
+                    )
+                    for index, addr in enumerate((":0", blocker.getsockname()))
+                ]
+            )
+        )
+        server = ser2sock.server.Server(config)
+        try:
+            with pytest.raises(OSError):
+                server._make_bridges()
+        finally:
+            server.selector.close()
+    # the resources of the bridge which did start were released
+    ((_, sock),) = prepared
+    assert sock.fileno() == -1
+
+
+def _run_python(*args):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(ser2sock.__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    return subprocess.run(
+        (sys.executable,) + args, env=env, stdout=subprocess.PIPE, timeout=10
+    )
+
+
+def test_startup_budget():
+    heavy = {
+        "bottle",
+        "wsgiref",
+        "json",
+        "pickle",
+        "hashlib",
+        "runpy",
+        "optparse",
+        "asyncio",
+        "multiprocessing",
+    }
+    code = "import sys, ser2sock.server; print(sorted(set(sys.modules) & {0!r}))"
+    start = time.time()
+    result = _run_python("-c", code.format(heavy))
+    elapsed = time.time() - start
+    assert result.stdout.strip() == b"[]"
+    assert elapsed < 2
+
+
+def test_check_config(tmp_path):
+    cfg_filename = tmp_path / "config.py"
+    # the port is not opened so being in use is not a problem
+    with socket.socket() as sock:
+        sock.bind(("", 0))
+        sock.listen(1)
+        port = sock.getsockname()[1]
+        cfg_filename.write_text(CONFIG_TEMPLATE.format(serial="/dev/ttyS0").replace(
+            '":0"', '":{0}"'.format(port)
+        ))
+        result = _run_python("-m", "ser2sock.server", "-c", str(cfg_filename),
+                             "--check-config")
+    assert result.returncode == 0
+    assert b"OK (1 bridges)" in result.stdout
+    cfg_filename.write_text('bridges = []\nengine = "bad"\n')
+    result = _run_python("-m", "ser2sock.server", "-c", str(cfg_filename),
+                         "--check-config")
+    assert result.returncode == 1
+
+
+def test_unknown_engine(tmp_path):
+    cfg_filename = tmp_path / 'config_bad_engine.py'
+    cfg_filename.write_text('bridges = []\nengine = "bad"\n')
+    with pytest.raises(ValueError):
+        ser2sock.config.load_config(str(cfg_filename))
+
+
+def test_workers(tmp_path):
+    template = CONFIG_TEMPLATE.replace(
+        "]\n]", "],\n    [serial(port='/dev/tty-void'), tcp(address=':0')]\n]"
+    ) + "workers = 2\n"
+    for server in _server(template, tmp_path):
+        bridges = server.collect_status()
+        assert len(bridges) == 2
+        ids = [[server.hardware.serial_name], ["/dev/tty-void"]]
+        assert [w.ids for w in server.workers] == ids
+        _, port = bridges[0].address
+        with socket.create_connection(('localhost', port)) as client:
+            client.sendall(REQUEST)
+            server.hardware.handle_request()
+            assert client.recv(1024) == REPLY
+            assert server.collect_status()[0].client_nb == 1
+        # a crashed worker is restarted
+        worker = server.workers[0]
+        pid = worker.process.pid
+        worker.process.kill()
+        while worker.restarts == 0:
+            time.sleep(0.01)
+        assert worker.process.pid != pid
+        while server.collect_status()[0].address is None:
+            time.sleep(0.01)
+        _, port = server.collect_status()[0].address
+        with socket.create_connection(('localhost', port)) as client:
+            client.sendall(REQUEST)
+            server.hardware.handle_request()
+            assert client.recv(1024) == REPLY
+
+
+def test_worker_restart_backoff():
+    from ser2sock.workers import Supervisor
+
+    with socket.socket() as blocker:
+        blocker.bind(("", 0))
+        blocker.listen(1)
+        # the second worker cannot start: its address is in use
+        config = ser2sock.config.sanitize_config(
+            dict(
+                bridges=[
+                    dict(
+                        name=str(index),
+                        serial=dict(port="/dev/tty-void"),
+                        tcp=dict(address=address),
+                    )
+                    for index, address in enumerate((":0", blocker.getsockname()))
+                ],
+                workers=2,
+            )
+        )
+        with Supervisor(config) as server:
+            thread = threading.Thread(target=server.run)
+            thread.start()
+            try:
+                time.sleep(1.2)
+            finally:
+                server.stop()
+                thread.join()
+        worker = server.workers[1]
+        # restarted at once, then after 0.5s (and the next one after 1s)
+        assert 1 <= worker.restarts <= 2
+        assert server.workers[0].restarts == 0
+
+
+def test_worker_late_reply():
+    import multiprocessing
+    from ser2sock.workers import Worker
+
+    worker = Worker(0, [])
+    worker.conn, child = multiprocessing.Pipe()
+    with pytest.raises(ser2sock.comm.TimeoutError):
+        worker.request(("status",), timeout=0.01)
+    assert child.recv() == ("status", 1)
+    # the reply to the request which timed out arrives late
+    child.send((1, "status"))
+    child.send((2, "loop stats"))
+    assert worker.request(("loop_stats",)) == "loop stats"
+    assert child.recv() == ("loop_stats", 2)
+
+
+FAN_OUT = dict(tcp=dict(max_clients=2, slow_client="disconnect"))
+
+
+@pytest.mark.parametrize("bridge_server", [FAN_OUT], indirect=True)
+def test_fan_out(bridge_server):
+    bridge = bridge_server.bridges[0]
+    _, port = bridge.sock.getsockname()
+    with socket.create_connection(('localhost', port)) as client1:
+        with socket.create_connection(('localhost', port)) as client2:
+            client2.sendall(REQUEST)
+            bridge_server.hardware.handle_request()
+            assert client1.recv(1024) == REPLY
+            assert client2.recv(1024) == REPLY
+            assert len(bridge.clients) == 2
+            # max_clients reached
+            with pytest.raises(ConnectionError):
+                with socket.create_connection(('localhost', port)) as client3:
+                    client3.sendall(REQUEST)
+                    assert not client3.recv(1024)
+                    raise ConnectionResetError()
+        client1.sendall(REQUEST)
+        bridge_server.hardware.handle_request()
+        assert client1.recv(1024) == REPLY
+
+
+@pytest.mark.parametrize("bridge_server", [FAN_OUT], indirect=True)
+def test_fan_out_slow_client_disconnect(bridge_server):
+    bridge = bridge_server.bridges[0]
+    _, port = bridge.sock.getsockname()
+    # big enough to fill the kernel socket buffers
+    payload = bytes(bytearray(range(256))) * 4096 * 16
+    with socket.create_connection(('localhost', port)) as fast:
+        # never reads
+        with socket.create_connection(('localhost', port)):
+            while len(bridge.clients) < 2:
+                time.sleep(0.01)
+            writer = threading.Thread(
+                target=os.write, args=(bridge_server.hardware.master_fd, payload)
+            )
+            writer.daemon = True
+            writer.start()
+            data = bytearray()
+            while len(data) < len(payload):
+                data += fast.recv(65536)
+            writer.join()
+            assert data == payload
+            assert len(bridge.clients) == 1
+
+
+@pytest.mark.parametrize(
+    "bridge_server",
+    [
+        dict(
+            tcp=dict(
+                max_clients=3,
+                mode="transaction",
+                reply_terminator=None,
+                reply_gap=0.05,
+            )
+        )
+    ],
+    indirect=True,
+)
+def test_transaction(bridge_server):
+    bridge = bridge_server.bridges[0]
+    hardware = bridge_server.hardware
+    _, port = bridge.sock.getsockname()
+    with socket.create_connection(('localhost', port)) as client1:
+        with socket.create_connection(('localhost', port)) as client2:
+            client1.settimeout(0.2)
+            client2.settimeout(0.2)
+            client1.sendall(REQUEST)
+            client2.sendall(REQUEST)
+            # requests are written one at a time
+            while len(bridge.arbiter.requests) != 1:
+                time.sleep(0.01)
+            hardware.handle_request()
+            replies = {}
+            for name, client in (("1", client1), ("2", client2)):
+                try:
+                    replies[name] = client.recv(1024)
+                except socket.timeout:
+                    pass
+            assert list(replies.values()) == [REPLY]
+            # the other client gets its reply once the device answers
+            hardware.handle_request()
+            other = client2 if "1" in replies else client1
+            other.settimeout(2)
+            assert other.recv(1024) == REPLY
+    assert bridge.arbiter.transactions == 2
+
+
+@pytest.mark.parametrize("engine", ser2sock.config.ENGINES)
+def test_timers(engine):
+    server = ser2sock.server.get_engine(engine)({"bridges": []})
+    calls = []
+    now = ser2sock.comm.monotonic()
+    server.call_at(now + 0.05, lambda: calls.append("b"))
+    server.call_later(0.02, lambda: calls.append("a"))
+    server.call_later(0, lambda: calls.append("x")).cancel()
+    periodic = server.call_every(0.005, lambda: calls.append("p"))
+    while "b" not in calls:
+        server.step()
+    periodic.cancel()
+    assert [call for call in calls if call != "p"] == ["a", "b"]
+    assert calls.count("p") >= 3
+    if engine == "selector":
+        # cancelled timers do not pile up
+        for _ in range(1000):
+            server.call_later(10, None).cancel()
+        assert len(server._timers) < 100
+        server.selector.close()
+    else:
+        server.loop.close()
+
+
+@pytest.mark.parametrize("engine", ser2sock.config.ENGINES)
+def test_loop_profiling(engine):
+    server = ser2sock.server.get_engine(engine)({"bridges": []})
+    assert server.loop_stats() is None
+    server.enable_profiling(slow_callback=0.01)
+    calls = []
+
+    def slow():
+        time.sleep(0.02)
+
+    server.call_later(0, slow)
+    server.call_later(0.01, lambda: calls.append("a"))
+    while not calls:
+        server.step()
+    stats = server.loop_stats()
+    assert stats["slow"] == 1
+    (name,) = [name for name in stats["callbacks"] if name.endswith("slow")]
+    assert stats["callbacks"][name]["count"] == 1
+    assert stats["callbacks"][name]["max"] >= 0.02
+    server.disable_profiling()
+    assert server.loop_stats() is None
+    if engine == "selector":
+        assert server.step == server.__class__.step.__get__(server)
+        server.selector.close()
+    else:
+        server.loop.close()
+
+
+def test_loop_profiling_per_bridge(profiled_server):
+    bridge = profiled_server.bridges[0]
+    _, port = bridge.sock.getsockname()
+    with socket.create_connection(('localhost', port)) as client:
+        client.sendall(REQUEST)
+        profiled_server.hardware.handle_request()
+        assert client.recv(1024) == REPLY
+    stats = profiled_server.run_in_loop(profiled_server.loop_stats)
+    assert stats["iterations"] > 0
+    assert stats["callbacks"]["Bridge.accept"]["count"] == 1
+    assert stats["callbacks"]["Bridge.tcp_to_serial"]["count"] >= 1
+    bid = profiled_server.hardware.serial_name
+    assert stats["bridges"][bid]["count"] >= 3
+
+
+def _fair_config(*serials):
+    bridges = [
+        dict(serial=dict(port=port, open_policy="always_open", **opts),
+             tcp=dict(address=":0"))
+        for port, opts in serials
+    ]
+    return ser2sock.config.sanitize_config(dict(bridges=bridges))
+
+
+@pytest.mark.parametrize("weight, limit", [(1, 16), (1.5, 24)])
+def test_read_budget(weight, limit):
+    with Hardware() as hardware:
+        options = dict(read_budget=16, weight=weight)
+        config = _fair_config((hardware.serial_name, options))
+        with ser2sock.server.Server(config) as server:
+            bridge = server.bridges[0]
+            _, port = bridge.sock.getsockname()
+            with socket.create_connection(('localhost', port)) as client:
+                while not bridge.clients:
+                    server.step()
+                data = bytes(range(100))
+                os.write(hardware.master_fd, data)
+                reads = []
+                while bridge.serial_bytes < len(data):
+                    server.step()
+                    reads.append(bridge.serial_bytes)
+                # never more than the budget per loop iteration
+                assert all(b - a <= limit for a, b in zip([0] + reads, reads))
+                received = b""
+                while len(received) < len(data):
+                    received += client.recv(1024)
+                assert received == data
+                assert bridge.deficit == 0
+
+
+def test_priority():
+    with Hardware() as low, Hardware() as high:
+        config = _fair_config(
+            (low.serial_name, dict(read_budget=4)),
+            (high.serial_name, dict(read_budget=4, priority=5)),
+        )
+        with ser2sock.server.Server(config) as server:
+            order = []
+
+            def spy(bridge):
+                forward = bridge.forward_serial
+
+                def forward_serial(data):
+                    order.append(bridge)
+                    forward(data)
+
+                bridge.forward_serial = forward_serial
+
+            for bridge in server.bridges:
+                spy(bridge)
+            clients = [
+                socket.create_connection(bridge.sock.getsockname())
+                for bridge in server.bridges
+            ]
+            try:
+                while not all(bridge.clients for bridge in server.bridges):
+                    server.step()
+                os.write(low.master_fd, b"low")
+                os.write(high.master_fd, b"high")
+                time.sleep(0.05)
+                server.step()
+            finally:
+                for client in clients:
+                    client.close()
+            assert order == [server.bridges[1], server.bridges[0]]
+    with pytest.raises(ValueError):
+        ser2sock.config.to_serial(dict(port="/dev/null", weight=0))
+
+
+def test_shared_stats(tmp_path):
+    filename = str(tmp_path / "stats")
+    with Hardware() as hardware:
+        config = _fair_config((hardware.serial_name, {}))
+        config.update(stats=filename, stats_interval=0.01)
+        with ser2sock.server.Server(config) as server:
+            bridge = server.bridges[0]
+            pid, (stats,) = ser2sock.shm.read_stats(filename)
+            assert pid == os.getpid()
+            assert stats["id"] == hardware.serial_name
+            assert stats["serial_state"] == "open"
+            assert stats["client_nb"] == 0
+            assert stats["client_ts"] == 0
+            _, port = bridge.sock.getsockname()
+            with socket.create_connection(('localhost', port)) as client:
+                client.sendall(REQUEST)
+                while bridge.client_bytes < len(REQUEST):
+                    server.step()
+                time.sleep(0.02)
+                server.step()
+            pid, (stats,) = ser2sock.shm.read_stats(filename)
+            assert stats["client_nb"] == 1
+            assert stats["clients"] == 1
+            assert stats["client_bytes"] == len(REQUEST)
+            assert stats["client_ts"] > 0
+            result = _run_python("-m", "ser2sock.shm", "--json", filename)
+            assert result.returncode == 0
+            (stats,) = json.loads(result.stdout)["bridges"]
+            assert stats["client_bytes"] == len(REQUEST)
+            # the slot of a removed bridge is cleared
+            server.reconfig(dict(config, bridges=[]))
+            time.sleep(0.02)
+            server.step()
+            assert ser2sock.shm.read_stats(filename)[1] == []
+        assert not os.path.exists(filename)
+
+
+def test_stats_file_busy(tmp_path, capsys):
+    # a slot stuck in the middle of an update (odd sequence number)
+    filename = tmp_path / "busy.stats"
+    shm = ser2sock.shm
+    filename.write_bytes(
+        shm.HEADER.pack(shm.MAGIC, shm.VERSION, 1, 0)
+        + shm.SEQ.pack(1)
+        + b"\0" * shm.SLOT.size
+    )
+    with pytest.raises(SystemExit):
+        shm.main([str(filename)])
+    assert "keeps changing" in capsys.readouterr().out
+
+
+def test_framers():
+    framer = ser2sock.framing.create_framer(terminator=b"\r\n")
+    assert framer.feed(b"a\r") == []
+    assert framer.feed(b"\nb\r\nc") == [b"a\r\n", b"b\r\n"]
+    assert framer.flush() == b"c"
+    framer = ser2sock.framing.create_framer(size=2)
+    assert framer.feed(b"abc") == [b"ab"]
+    assert framer.feed(b"d") == [b"cd"]
+    framer = ser2sock.framing.create_framer(length_prefix=">H")
+    assert framer.feed(b"\x00\x02a") == []
+    assert framer.feed(b"b\x00\x00\x00") == [b"\x00\x02ab", b"\x00\x00"]
+    assert len(framer) == 1
+    for prefix in (">b", ">bb", "xx", ">f"):
+        # a signed length could be negative: never a valid frame
+        with pytest.raises(ValueError):
+            ser2sock.framing.LengthPrefixFramer(prefix)
+        with pytest.raises(ValueError):
+            config = dict(port="/dev/null", frame_length_prefix=prefix)
+            ser2sock.config.to_serial(config)
+
+
+@pytest.mark.parametrize(
+    "bridge_server",
+    [
+        dict(serial=dict(frame_terminator=b"\n"), tcp=dict(zero_copy=zero_copy))
+        for zero_copy in (False, True)
+    ],
+    indirect=True,
+    ids=["copy", "zero_copy"],
+)
+def test_framing(bridge_server):
+    bridge = bridge_server.bridges[0]
+    hardware = bridge_server.hardware
+    _, port = bridge.sock.getsockname()
+    with socket.create_connection(('localhost', port)) as client:
+        client.settimeout(2)
+        while not bridge.clients:
+            time.sleep(0.01)
+        os.write(hardware.master_fd, REPLY[:10])
+        time.sleep(0.1)
+        os.write(hardware.master_fd, REPLY[10:] + b"\n" + REPLY[:5])
+        # the whole frame comes in a single segment
+        assert client.recv(1024) == REPLY + b"\n"
+        assert bridge.serial_pipe is None
+    assert bridge.serial_frames == 1
+    # the time spent in the framer counts as latency
+    state = bridge_server.run_in_loop(bridge.histograms["serial_to_tcp"].state)
+    assert state["count"] == 1
+    assert state["sum"] >= 0.09
+    assert bridge.serial_frame_max == len(REPLY) + 1
+
+
+@pytest.mark.parametrize(
+    "bridge_server",
+    [
+        dict(serial=dict(open_policy=policy, idle_timeout=0.1))
+        for policy in ("always_open", "idle_timeout")
+    ],
+    indirect=True,
+    ids=["always_open", "idle_timeout"],
+)
+def test_open_policy(bridge_server):
+    bridge = bridge_server.bridges[0]
+    policy = bridge.config["serial"]["open_policy"]
+    assert bridge.serial.isOpen() == (policy == "always_open")
+    _, port = bridge.sock.getsockname()
+    for _ in range(2):
+        with socket.create_connection(('localhost', port)) as client:
+            client.sendall(REQUEST)
+            bridge_server.hardware.handle_request()
+            assert client.recv(1024) == REPLY
+        while bridge.clients:
+            time.sleep(0.01)
+        # the serial line survives the client
+        assert bridge.serial.isOpen()
+    time.sleep(0.2)
+    assert bridge.serial.isOpen() == (policy == "always_open")
+
+
+@pytest.mark.parametrize(
+    "bridge_server",
+    [
+        dict(
+            serial=dict(
+                reconnect=True,
+                reconnect_delay=0.01,
+                reconnect_max_delay=0.04,
+                keep_clients=True,
+            )
+        )
+    ],
+    indirect=True,
+)
+def test_reconnect(bridge_server):
+    bridge = bridge_server.bridges[0]
+    _, port = bridge.sock.getsockname()
+    with socket.create_connection(('localhost', port)) as client:
+        while bridge.serial_state != "open":
+            time.sleep(0.01)
+        # device goes away
+        bridge_server.hardware.close()
+        while bridge.reconnect_attempts < 3:
+            time.sleep(0.01)
+        assert bridge.serial_state == "reconnecting"
+        assert bridge.serial_losses == 1
+        # the client is kept and its data queued
+        client.sendall(REQUEST)
+        while not bridge.serial_buffer:
+            time.sleep(0.01)
+        assert len(bridge.clients) == 1
+
+
+@pytest.mark.parametrize(
+    "bridge_server",
+    [
+        dict(
+            tcp=dict(
+                takeover="replace_oldest",
+                keepalive=True,
+                keep_idle=5,
+                keep_interval=2,
+                keep_count=3,
+            )
+        )
+    ],
+    indirect=True,
+)
+def test_takeover(bridge_server):
+    bridge = bridge_server.bridges[0]
+    hardware = bridge_server.hardware
+    _, port = bridge.sock.getsockname()
+    with socket.create_connection(('localhost', port)) as client1:
+        client1.settimeout(2)
+        while not bridge.clients:
+            time.sleep(0.01)
+        sock = bridge.clients[0].sock
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+        assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE) == 5
+        with socket.create_connection(('localhost', port)) as client2:
+            client2.settimeout(2)
+            # the new client replaces the old one
+            assert client1.recv(1024) == b""
+            client2.sendall(REQUEST)
+            hardware.handle_request()
+            assert client2.recv(1024) == REPLY
+    assert bridge.client_nb == 2
+
+
+def test_reload(server, tmp_path):
+    bridge = server.bridges[0]
+    _, port = bridge.sock.getsockname()
+    filename = server.config["filename"]
+    with open(filename) as cfg_file:
+        text = cfg_file.read()
+    with socket.create_connection(('localhost', port)) as client:
+        # add a bridge: the existing one (and its client) is left alone
+        with open(filename, "w") as cfg_file:
+            cfg_file.write(text.replace(
+                "]\n]",
+                "],\n    dict(name='void', serial=serial(port='/dev/tty-void'), "
+                "tcp=tcp(address=':0'))\n]",
+            ))
+        server.request_reload()
+        while len(server.bridges) != 2:
+            time.sleep(0.01)
+        assert server.bridges[0] is bridge
+        assert server.bridges[1].config["name"] == "void"
+        client.sendall(REQUEST)
+        server.hardware.handle_request()
+        assert client.recv(1024) == REPLY
+        # remove it again
+        with open(filename, "w") as cfg_file:
+            cfg_file.write(text)
+        server.request_reload()
+        while len(server.bridges) != 1:
+            time.sleep(0.01)
+        assert server.bridges == [bridge]
+
+
+def test_reload_address_in_use(server):
+    bridge = server.bridges[0]
+    _, port = bridge.sock.getsockname()
+    filename = server.config["filename"]
+    with open(filename) as cfg_file:
+        text = cfg_file.read()
+    with socket.socket() as blocker:
+        blocker.bind(("", 0))
+        blocker.listen(1)
+        address = ":{0}".format(blocker.getsockname()[1])
+        with socket.create_connection(("localhost", port)) as client:
+            with open(filename, "w") as cfg_file:
+                new = "address={0!r}".format(address)
+                cfg_file.write(text.replace('address=":0"', new))
+            server.request_reload()
+            # messages to the loop are handled in order: reload happened
+            server.run_in_loop(lambda: None)
+            # the failure is logged, the bridge and its client are kept
+            assert server.thread.is_alive()
+            assert server.bridges == [bridge]
+            assert bridge.sock.getsockname()[1] == port
+            assert bridge.config["tcp"]["address"] != address
+            client.sendall(REQUEST)
+            server.hardware.handle_request()
+            assert client.recv(1024) == REPLY
+
+
+def test_watch(tmp_path):
+    for server in _server(CONFIG_TEMPLATE + "watch = 0.05\n", tmp_path):
+        filename = server.config["filename"]
+        with open(filename) as cfg_file:
+            text = cfg_file.read()
+        with open(filename, "w") as cfg_file:
+            text = text.replace('tcp(address=":0")', 'tcp(address=":0", tos=0)')
+            cfg_file.write(text)
+        while server.bridges[0].config["tcp"]["tos"] != 0:
+            time.sleep(0.01)
+
+
+@pytest.mark.parametrize(
+    "bridge_server", [dict(tcp=dict(batch_delay=0.2, batch_size=64))], indirect=True
+)
+def test_batch(bridge_server):
+    bridge = bridge_server.bridges[0]
+    hardware = bridge_server.hardware
+    _, port = bridge.sock.getsockname()
+    with socket.create_connection(('localhost', port)) as client:
+        client.settimeout(0.1)
+        while not bridge.clients:
+            time.sleep(0.01)
+        # small chunks are held back until batch_delay expires...
+        start = time.time()
+        os.write(hardware.master_fd, b"a")
+        with pytest.raises(socket.timeout):
+            client.recv(1024)
+        os.write(hardware.master_fd, b"b")
+        client.settimeout(2)
+        assert client.recv(1024) == b"ab"
+        assert time.time() - start > 0.15
+        # ... unless batch_size is reached
+        payload = 100 * b"c"
+        os.write(hardware.master_fd, payload)
+        data = bytearray()
+        while len(data) < len(payload):
+            data += client.recv(1024)
+        assert data == payload
+
+
+@pytest.mark.parametrize(
+    "bridge_server",
+    [
+        dict(
+            tcp=dict(
+                mode="transaction",
+                reply_terminator=None,
+                reply_gap=0.05,
+                cache=[REQUEST],
+                cache_ttl=60,
+            )
+        )
+    ],
+    indirect=True,
+)
+def test_cache(bridge_server):
+    bridge = bridge_server.bridges[0]
+    hardware = bridge_server.hardware
+    _, port = bridge.sock.getsockname()
+    with socket.create_connection(('localhost', port)) as client:
+        client.settimeout(2)
+        client.sendall(REQUEST)
+        hardware.handle_request()
+        assert client.recv(1024) == REPLY
+        # second time the device is not involved
+        client.sendall(REQUEST)
+        assert client.recv(1024) == REPLY
+    assert bridge.cache_hits == 1
+    assert bridge.cache_misses == 1
+    assert bridge.arbiter.transactions == 1
+
+
+def test_reply_cache():
+    import re
+    from ser2sock.cache import ReplyCache
+
+    cache = ReplyCache([re.compile(b"a|ab"), b"x"], size=2)
+    # regular expressions must match the whole request
+    assert cache.cacheable(b"ab") and cache.cacheable(b"a")
+    assert not cache.cacheable(b"abc")
+    cache.put(b"a", b"1")
+    cache.put(b"ab", b"2")
+    assert cache.get(b"a") == b"1"
+    # least recently used goes first
+    cache.put(b"x", b"3")
+    assert list(cache.entries) == [b"a", b"x"]
+
+
+def test_cache_needs_transaction_mode():
+    with pytest.raises(ValueError):
+        ser2sock.config.to_tcp(dict(address=":0", cache=[REQUEST]))
+
+
+def test_metrics_default():
+    sanitize = ser2sock.config.sanitize_config
+    # the metrics are only computed when the web UI can serve them
+    assert sanitize(dict(bridges=[]))["metrics"] == 0
+    assert sanitize(dict(bridges=[], web=":0"))["metrics"] == 5
+
+
+@pytest.mark.parametrize("terminator", [None, ""])
+def test_transaction_needs_request_terminator(terminator):
+    with pytest.raises(ValueError):
+        ser2sock.config.to_tcp(
+            dict(address=":0", mode="transaction", request_terminator=terminator)
+        )
+
+
+def test_web_does_not_stall_bridges(web_server):
+    bridge = web_server.bridges[0]
+    while not hasattr(getattr(web_server, "web_server", None), "web_server"):
+        time.sleep(0.01)
+    web_addr = web_server.web_server.web_server.socket.getsockname()
+    url = 'http://localhost:{}/'.format(web_addr[1])
+    stop = threading.Event()
+
+    def hammer():
+        while not stop.is_set():
+            with urllib.request.urlopen(url) as f:
+                f.read()
+
+    hammers = [threading.Thread(target=hammer) for _ in range(4)]
+    for hammer_thread in hammers:
+        hammer_thread.start()
+    # a client which never sends the body it announced
+    with socket.create_connection(('localhost', web_addr[1])) as stalled:
+        stalled.sendall(b"POST / HTTP/1.0\r\nContent-Length: 100\r\n\r\n")
+        _, port = bridge.sock.getsockname()
+        latencies = []
+        with socket.create_connection(('localhost', port)) as client:
+            client.settimeout(2)
+            for _ in range(20):
+                start = time.time()
+                client.sendall(REQUEST)
+                web_server.hardware.handle_request()
+                assert client.recv(1024) == REPLY
+                latencies.append(time.time() - start)
+    stop.set()
+    for hammer_thread in hammers:
+        hammer_thread.join()
+    assert max(latencies) < 0.5
+
+
+def test_histogram():
+    hist = ser2sock.metrics.Histogram((0.001, 0.01))
+    for value in (0.0, 0.001, 0.005, 1):
+        hist.observe(value)
+    state = hist.state()
+    assert state["counts"] == [2, 1, 1]
+    assert state["count"] == 4
+
+
+def test_observe_written():
+    hist = ser2sock.metrics.Histogram((1, 10))
+    now = ser2sock.comm.monotonic()
+    # two chunks queued 5s and 20s ago, the older one first
+    queue = collections.deque([[4, now - 20], [4, now - 5]])
+    ser2sock.bridge.observe_written(queue, 6, hist)
+    # each chunk is observed with its own wait once fully written
+    assert hist.state()["counts"] == [0, 0, 1]
+    assert list(queue) == [[2, now - 5]]
+    ser2sock.bridge.observe_written(queue, 2, hist)
+    assert hist.state()["counts"] == [0, 1, 1]
+    assert not queue
+
+
+def test_metrics(metrics_server):
+    bridge = metrics_server.bridges[0]
+    web_server = metrics_server
+    while not hasattr(getattr(web_server, "web_server", None), "web_server"):
+        time.sleep(0.01)
+    _, web_port = metrics_server.web_server.web_server.socket.getsockname()
+    url = 'http://localhost:{}'.format(web_port)
+    _, port = bridge.sock.getsockname()
+    with socket.create_connection(('localhost', port)) as client:
+        for _ in range(3):
+            client.sendall(REQUEST)
+            metrics_server.hardware.handle_request()
+            assert client.recv(1024) == REPLY
+        # wait for the next sample
+        time.sleep(0.3)
+        with urllib.request.urlopen(url + '/api/status') as f:
+            status = json.load(f)
+        with urllib.request.urlopen(url + '/metrics') as f:
+            assert f.headers["Content-Type"].startswith("text/plain")
+            text = f.read().decode()
+    (info,) = status["bridges"]
+    assert info["id"] == metrics_server.hardware.serial_name
+    assert info["clients"] == 1
+    assert info["counters"]["client_bytes"] == 3 * len(REQUEST)
+    assert info["counters"]["serial_bytes"] == 3 * len(REPLY)
+    assert info["counters"]["client_reads"] == 3
+    assert info["queues"]["serial_buffered"] == 0
+    assert set(info["rates"]) >= {"tcp_to_serial_bytes", "serial_to_tcp_bytes"}
+    assert info["latency"]["tcp_to_serial"]["count"] == 3
+    assert info["latency"]["serial_to_tcp"]["count"] == 3
+    labels = 'bridge="{}"'.format(metrics_server.hardware.serial_name)
+    assert 'ser2sock_client_bytes_total{{{}}} {}'.format(
+        labels, 3 * len(REQUEST)
+    ) in text
+    assert 'ser2sock_latency_seconds_count{{{},path="tcp_to_serial"}} 3'.format(
+        labels
+    ) in text
+    assert "ser2sock_tcp_to_serial_bytes_per_second{" in text
+
+
+def test_capture_ring(tmp_path):
+    filename = str(tmp_path / "ring.cap")
+    capture = ser2sock.capture.Capture(filename, size=4096, rotate=2)
+    record = ser2sock.capture.RECORD.size
+    for i in range(100):
+        capture.write(ser2sock.capture.SERIAL_TO_TCP, bytes([i]) * 100)
+    # payloads larger than a quarter of the ring are truncated
+    capture.write(ser2sock.capture.TCP_TO_SERIAL, b"x" * 2000)
+    records = ser2sock.capture.read_capture(filename)
+    assert sum(record + len(data) for _, _, data, _ in records) <= 4096
+    assert records[-1][1:] == (ser2sock.capture.TCP_TO_SERIAL, b"x" * 1024, 2000)
+    assert records[-2][2] == bytes([99]) * 100
+    # the ring wrapped: oldest records were saved to pcap files before
+    # being overwritten and only the last 2 files are kept (closing waits
+    # for the pcap files to be written)
+    capture.close()
+    pcaps = sorted(p.name for p in tmp_path.glob("ring.cap.*.pcap"))
+    assert len(pcaps) == 2
+    result = _run_python("-m", "ser2sock.capture", filename)
+    assert result.returncode == 0
+    assert b"tcp->serial 2000 bytes (truncated)" in result.stdout
+    result = _run_python("-m", "ser2sock.capture", "--hex", filename)
+    assert b"    0000  63 63 63 63" in result.stdout
+    pcap = str(tmp_path / "out.pcap")
+    result = _run_python("-m", "ser2sock.capture", "--pcap", pcap, filename)
+    assert result.returncode == 0
+    with open(pcap, "rb") as fobj:
+        assert fobj.read(4) == b"\xd4\xc3\xb2\xa1"
+
+
+def test_capture_private(tmp_path, monkeypatch):
+    monkeypatch.setenv("SER2SOCK_CACHE_DIR", str(tmp_path / "cache"))
+    directory = ser2sock.capture.capture_dir()
+    assert directory.startswith(str(tmp_path / "cache"))
+    filename = os.path.join(directory, "ring.cap")
+    ser2sock.capture.Capture(filename, size=4096).close()
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+    assert os.stat(filename).st_mode & 0o777 == 0o600
+    # a symbolic link planted in place of the capture file is not followed
+    target = tmp_path / "target"
+    target.write_bytes(b"precious")
+    os.unlink(filename)
+    os.symlink(str(target), filename)
+    with pytest.raises(OSError):
+        ser2sock.capture.Capture(filename, size=4096)
+    assert target.read_bytes() == b"precious"
+    # nor is a directory others can write to used
+    shared = tmp_path / "shared"
+    shared.mkdir()
+    os.chmod(str(shared), 0o777)
+    with pytest.raises(OSError):
+        ser2sock.capture.Capture(str(shared / "ring.cap"), size=4096)
+
+
+def test_capture_toggle(tmp_path):
+    template = WEB_CONFIG_TEMPLATE + "capture_dir = {0!r}\n".format(str(tmp_path))
+    for server in _server(template, tmp_path):
+        bridge = server.bridges[0]
+        while not hasattr(getattr(server, "web_server", None), "web_server"):
+            time.sleep(0.01)
+        _, web_port = server.web_server.web_server.socket.getsockname()
+        data = urllib.parse.urlencode({"serial-capture-0": "on"}).encode()
+        with urllib.request.urlopen('http://localhost:{}/'.format(web_port), data):
+            pass
+        assert bridge.capture_file.startswith(str(tmp_path))
+        _, port = bridge.sock.getsockname()
+        with socket.create_connection(('localhost', port)) as client:
+            client.sendall(REQUEST)
+            server.hardware.handle_request()
+            assert client.recv(1024) == REPLY
+        records = ser2sock.capture.read_capture(bridge.capture_file)
+        assert [(r[1], r[2]) for r in records] == [
+            (ser2sock.capture.TCP_TO_SERIAL, REQUEST),
+            (ser2sock.capture.SERIAL_TO_TCP, REPLY),
+        ]
+        data = urllib.parse.urlencode({"serial-capture-0": "off"}).encode()
+        with urllib.request.urlopen('http://localhost:{}/'.format(web_port), data):
+            pass
+        assert bridge.capture is None
+
+
+def test_web_reconfig(web_server):
+    bridge = web_server.bridges[0]
+    while not hasattr(getattr(web_server, "web_server", None), "web_server"):
+        time.sleep(0.01)
+    _, web_port = web_server.web_server.web_server.socket.getsockname()
+    form = {
+        "serial-port-0": web_server.hardware.serial_name,
+        "serial-baudrate-0": "19200",
+        "serial-bytesize-0": "8",
+        "serial-parity-0": "N",
+        "serial-stopbits-0": "1",
+        "tcp-address-0": bridge.config["tcp"]["address"],
+    }
+    data = urllib.parse.urlencode(form).encode()
+    with urllib.request.urlopen('http://localhost:{}/'.format(web_port), data):
+        pass
+    assert bridge.config["serial"]["baudrate"] == 19200
+    # options which are not in the form are kept
+    assert bridge.config["tcp"]["mode"] == "stream"